@@ -17,6 +17,47 @@ from .cameras import (
     Cameras,
 )
 from .exceptions import *
+from .probe import (
+    DEF_PROBE_TIMEOUT,
+    CameraInfo,
+    probe_cameras,
+)
+from .grabber import (
+    DEF_BUFFER_SIZE,
+    Frame,
+    Timestamp,
+    FrameGrabber,
+)
+from .sync import (
+    DEF_MAX_REJECTED,
+    SkewStats,
+    match_frames,
+)
+from .metrics import (
+    Histogram,
+    Metrics,
+)
+from .transforms import (
+    TransformChain,
+    crop,
+)
+from .pipeline import (
+    DEF_QUEUE_SIZE,
+    DropQueue,
+    Pipeline,
+)
+from .replay import (
+    DEF_REPLAY_FPS,
+    DEF_PREFETCH,
+    ImageSequenceCapture,
+    ReplayCapture,
+    ReplayCameras,
+)
+from .encoder import (
+    DEF_JPEG_QUALITY,
+    DEF_MAX_DISPLAY_FPS,
+    WidgetEncoder,
+)
 from .stream import (
     Stream,
     NStream,
@@ -24,6 +65,13 @@ from .stream import (
     NDepthStream,
     NDepthStreamExt,
 )
+from .matchers import (
+    DEF_MATCHER,
+    MATCHERS,
+    Matcher,
+    register_matcher,
+    create_matcher,
+)
 from .depthmap import (
     StereoVision,
     StereoVision2Cams,
@@ -1,14 +1,18 @@
 import stereo as st
 import numpy as np
 import cv2 as cv
+import sys
 
 
+if len(sys.argv) > 1 and sys.argv[1] == "bench":
+    from stereo.bench import main
+    main(sys.argv[2:])
+    sys.exit()
+
 calibration = st.Calibration2Cams()
 calibration.load("calibrated/2cam-usb-12cm-v1.yaml")
 
-cameras = st.Cameras([0, 1], transformations=[
-    (cv.cvtColor, cv.COLOR_BGR2GRAY)
-])
+cameras = st.Cameras([0, 1], gray=True)
 stereo = st.StereoVision2Cams(calibration)
 
 cameras.capture()
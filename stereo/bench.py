@@ -0,0 +1,313 @@
+from .calibration import Calibration2Cams
+from .depthmap import StereoVision2Cams
+from .encoder import DEF_JPEG_QUALITY
+from .exceptions import NoCalibrationImages
+from .matchers import DEF_MATCHER, MATCHERS
+from .replay import ReplayCapture
+import cv2 as cv
+import numpy as np
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import logging
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEF_BENCH_FRAMES = 30
+DEF_BENCH_SCALES = (1.0, 0.5, 0.25)
+DEF_BENCH_CALIBRATION = os.path.join("calibrated", "2cam-usb-12cm-v1.yaml")
+DEF_BENCH_DISPARITY = 32
+DEF_BENCH_PAIRS = 100
+BENCH_STAGES = ("preprocess", "match", "colormap", "jpeg")
+
+
+def measure_fps(stereo, left, right, frames=DEF_BENCH_FRAMES):
+    """Return the number of depth maps per second the given StereoVision2Cams
+    calculates for a pair of frames.
+    """
+    stereo.left, stereo.right = left, right
+    stereo.calculate_depth()
+    start_time = time.perf_counter()
+    for _ in range(frames):
+        stereo.calculate_depth()
+    return frames / (time.perf_counter() - start_time)
+
+
+def bench_scales(calibration, left, right, scales=DEF_BENCH_SCALES,
+                 refine=(False, True), frames=DEF_BENCH_FRAMES, **kwargs):
+    """Measure the frame rate of StereoVision2Cams for each scale of the
+    multi-resolution mode, with and without refinement. Return a list of
+    dicts.
+    """
+    results = []
+    for scale in scales:
+        for refine_mode in refine:
+            if scale == 1.0 and refine_mode:
+                continue
+            stereo = StereoVision2Cams(calibration, scale=scale,
+                                       refine=refine_mode, **kwargs)
+            fps = measure_fps(stereo, left, right, frames)
+            logging.info("scale: {}\trefine: {}\tfps: {:.2f}".format(
+                scale, refine_mode, fps))
+            results.append({"scale": scale, "refine": refine_mode, "fps": fps})
+    return results
+
+
+def bench_tiles(calibration, left, right, workers=None, tiles=None,
+                frames=DEF_BENCH_FRAMES, **kwargs):
+    """Measure the frame rate of tiled parallel matching for increasing
+    numbers of worker threads (up to the number of cores by default). Return
+    a list of dicts.
+    """
+    if workers is None:
+        workers = sorted({1, 2, 4, 8, os.cpu_count() or 1})
+        workers = [count for count in workers if count <= (os.cpu_count() or 1)]
+
+    results = []
+    for count in workers:
+        tile_count = count if tiles is None else tiles
+        stereo = StereoVision2Cams(calibration, tiles=tile_count,
+                                   workers=count, **kwargs)
+        fps = measure_fps(stereo, left, right, frames)
+        logging.info("workers: {}\ttiles: {}\tfps: {:.2f}".format(
+            count, tile_count, fps))
+        results.append({"workers": count, "tiles": tile_count, "fps": fps})
+    return results
+
+
+def bench_chessboards(calibration_path, scales=DEF_BENCH_SCALES,
+                      sb=(False, True)):
+    """Measure chessboard detection time and the resulting re-projection
+    errors for each detection scale, with and without
+    cv.findChessboardCornersSB. Return a list of dicts.
+    """
+    images = Calibration2Cams()
+    images.calibration_path = calibration_path
+    images.load_images()
+
+    results = []
+    for scale in scales:
+        for use_sb in sb:
+            calibration = Calibration2Cams()
+            calibration.left_imgs = images.left_imgs
+            calibration.right_imgs = images.right_imgs
+            calibration.width, calibration.height = images.width, images.height
+            calibration.detection_scale = scale
+            calibration.detection_sb = use_sb
+
+            start_time = time.perf_counter()
+            try:
+                pairs = calibration.find_chessboards()
+            except NoCalibrationImages:
+                pairs = 0
+            detection_time = time.perf_counter() - start_time
+
+            result = {"scale": scale, "sb": use_sb, "pairs": pairs,
+                      "time": detection_time}
+            if pairs:
+                calibration.calibrate_chessboards()
+                result["left_error"] = calibration.left_reprojection_error
+                result["right_error"] = calibration.right_reprojection_error
+            logging.info("scale: {}\tsb: {}\tpairs: {}\ttime: {:.2f}s"
+                         .format(scale, use_sb, pairs, detection_time))
+            results.append(result)
+    return results
+
+
+def synthetic_pair(size, disparity=DEF_BENCH_DISPARITY, seed=0):
+    """Return a grayscale (left, right) pair of the given (width, height) with
+    a random texture shifted by disparity pixels.
+    """
+    rng = np.random.default_rng(seed)
+    left = rng.integers(0, 256, (size[1], size[0]), dtype=np.uint8)
+    left = cv.GaussianBlur(left, (3, 3), 0)
+    right = np.roll(left, -disparity, axis=1)
+    return left, right
+
+
+def recorded_pairs(left_path, right_path, size, count=DEF_BENCH_PAIRS):
+    """Read up to count pairs of a recording (image directories or video
+    files, see ReplayCapture) as grayscale frames of the given size.
+    """
+    captures = [ReplayCapture(path, rate=None, gray=True)
+                for path in (left_path, right_path)]
+    pairs = []
+    try:
+        while len(pairs) < count:
+            pair = []
+            for capture in captures:
+                ret, frame = capture.read()
+                if not ret:
+                    break
+                if frame.ndim == 3:
+                    frame = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+                if (frame.shape[1], frame.shape[0]) != tuple(size):
+                    frame = cv.resize(frame, tuple(size),
+                                      interpolation=cv.INTER_AREA)
+                pair.append(frame)
+            if len(pair) < 2:
+                break
+            pairs.append(tuple(pair))
+    finally:
+        for capture in captures:
+            capture.release()
+    return pairs
+
+
+def _encode_jpeg(img, quality=DEF_JPEG_QUALITY):
+    _, data = cv.imencode(".jpg", img, (cv.IMWRITE_JPEG_QUALITY, quality))
+    return data.tobytes()
+
+
+def _percentiles(times):
+    times = np.array(times) * 1000
+    return {
+        "mean": float(times.mean()),
+        "p50": float(np.percentile(times, 50)),
+        "p95": float(np.percentile(times, 95)),
+        "p99": float(np.percentile(times, 99)),
+    }
+
+
+def _max_rss():
+    """Return the peak resident set size of the process in bytes or None."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and in bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def bench_pipeline(stereo, pairs, frames=DEF_BENCH_FRAMES):
+    """Run the depth pipeline of a stream (rectification, matching, colormap
+    and JPEG encoding) on the pairs in turn and return per-stage latencies in
+    milliseconds and the throughput in frames per second.
+    """
+    times = {name: [] for name in BENCH_STAGES}
+    times["total"] = []
+    start_time = time.perf_counter()
+    for idx in range(frames):
+        stereo.left, stereo.right = pairs[idx % len(pairs)]
+
+        t0 = time.perf_counter()
+        stereo.preprocess_frames()
+        t1 = time.perf_counter()
+        stereo.depth = stereo.match(stereo.left_rectified,
+                                    stereo.right_rectified,
+                                    stereo.disparity, stereo.depth)
+        t2 = time.perf_counter()
+        colored = cv.applyColorMap(stereo.depth, cv.COLORMAP_JET)
+        t3 = time.perf_counter()
+        _encode_jpeg(colored)
+        t4 = time.perf_counter()
+
+        for name, (begin, end) in zip(BENCH_STAGES, ((t0, t1), (t1, t2),
+                                                     (t2, t3), (t3, t4))):
+            times[name].append(end - begin)
+        times["total"].append(t4 - t0)
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        "frames": frames,
+        "fps": frames / elapsed,
+        "stages": {name: _percentiles(values)
+                   for name, values in times.items()},
+    }
+
+
+def bench_depth(calibration, pairs, scales=DEF_BENCH_SCALES,
+                matchers=(DEF_MATCHER,), frames=DEF_BENCH_FRAMES, **kwargs):
+    """Benchmark the depth pipeline for each scale and matcher. Peak memory
+    is the peak of memory traced while creating StereoVision2Cams and
+    processing the first pair. Return a list of dicts.
+    """
+    results = []
+    for matcher in matchers:
+        for scale in scales:
+            tracemalloc.start()
+            stereo = StereoVision2Cams(calibration, matcher=matcher,
+                                       scale=scale, **kwargs)
+            bench_pipeline(stereo, pairs, 1)
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            result = {"matcher": matcher, "scale": scale,
+                      "size": list(stereo.left_rectified.shape[::-1]),
+                      "peak_memory": peak_memory}
+            result.update(bench_pipeline(stereo, pairs, frames))
+            logging.info("matcher: {}\tscale: {}\tfps: {:.2f}\t"
+                         "p50: {:.2f} ms\tp99: {:.2f} ms".format(
+                             matcher, scale, result["fps"],
+                             result["stages"]["total"]["p50"],
+                             result["stages"]["total"]["p99"]))
+            results.append(result)
+    return results
+
+
+def main(argv=None):
+    """Command line interface of the depth pipeline benchmark, run with
+    python -m stereo bench.
+    """
+    parser = argparse.ArgumentParser(prog="python -m stereo bench",
+        description="Benchmark the depth pipeline on synthetic or recorded "
+                    "stereo pairs.")
+    parser.add_argument("--calibration", default=DEF_BENCH_CALIBRATION,
+                        help="calibration filename")
+    parser.add_argument("--left", help="left recording (image directory or "
+                                       "video file), synthetic if not given")
+    parser.add_argument("--right", help="right recording")
+    parser.add_argument("--scales", type=float, nargs="+",
+                        default=DEF_BENCH_SCALES)
+    parser.add_argument("--matchers", nargs="+", default=[DEF_MATCHER],
+                        choices=sorted(MATCHERS))
+    parser.add_argument("--frames", type=int, default=DEF_BENCH_FRAMES)
+    parser.add_argument("--fixed-point-maps", action="store_true")
+    parser.add_argument("--json", help="write results to a JSON file")
+    args = parser.parse_args(argv)
+    if (args.left is None) != (args.right is None):
+        parser.error("--left and --right have to be given together")
+
+    calibration = Calibration2Cams()
+    calibration.load(args.calibration)
+    size = (calibration.width, calibration.height)
+    if args.left is None:
+        source = "synthetic"
+        pairs = [synthetic_pair(size)]
+    else:
+        source = "recorded"
+        pairs = recorded_pairs(args.left, args.right, size)
+        if not pairs:
+            parser.error("no frames read from the recording")
+
+    results = bench_depth(calibration, pairs, args.scales, args.matchers,
+                          args.frames, fixed_point_maps=args.fixed_point_maps)
+    report = {
+        "source": source,
+        "calibration": args.calibration,
+        "pairs": len(pairs),
+        "opencv": cv.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "max_rss": _max_rss(),
+        "results": results,
+    }
+
+    for result in results:
+        print("{} scale {} {}x{}: {:.2f} fps, peak memory {:.1f} MiB".format(
+            result["matcher"], result["scale"], *result["size"],
+            result["fps"], result["peak_memory"] / 2**20))
+        for name, stage in result["stages"].items():
+            print("  {:<11} p50 {:8.2f} ms  p95 {:8.2f} ms  p99 {:8.2f} ms"
+                  .format(name, stage["p50"], stage["p95"], stage["p99"]))
+
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+    return report
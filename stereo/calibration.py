@@ -5,10 +5,204 @@ import numpy as np
 import os
 import yaml
 import json
+import hashlib
 import logging
+import struct
+import tempfile
+import zipfile
+import functools
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 DEF_CALIB_IMG_PATH = os.path.normpath("calibration-images")
+DEF_MIN_VIEWS = 10
+
+_MAP_NAMES = ("left_map_x", "left_map_y", "right_map_x", "right_map_y")
+_FORMATS = {".json": "json", ".yaml": "yaml", ".yml": "yaml", ".npz": "npz",
+    ".xml": "opencv"}
+
+
+class CalibrationLoader(yaml.SafeLoader):
+    """Safe YAML loader which also accepts tuples written by yaml.dump()."""
+
+    def construct_python_tuple(self, node):
+        return tuple(self.construct_sequence(node))
+
+
+CalibrationLoader.add_constructor("tag:yaml.org,2002:python/tuple",
+    CalibrationLoader.construct_python_tuple)
+
+
+def load_npz(filename):
+    """Load all arrays of a .npz file into a dict. Arrays stored without
+    compression (as by np.savez()) are memory-mapped instead of being read.
+    """
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive, open(filename, "rb") as file:
+        for info in archive.infolist():
+            name = info.filename[:-len(".npy")]
+            if info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[name] = np.load(member)
+                continue
+
+            # Skip the local file header to the .npy data
+            file.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", file.read(4))
+            file.seek(name_length + extra_length, os.SEEK_CUR)
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = \
+                    np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = \
+                    np.lib.format.read_array_header_2_0(file)
+
+            # Scalars and empty arrays cannot be memory-mapped
+            if dtype.hasobject or not shape or 0 in shape:
+                with archive.open(info) as member:
+                    arrays[name] = np.load(member)
+            else:
+                arrays[name] = np.memmap(filename, dtype, "r", file.tell(),
+                    shape, "F" if fortran_order else "C")
+    return arrays
+
+
+def write_atomic(filename, write):
+    """Call write with a binary file object of a temporary file in the
+    directory of filename and move it in place of filename when done, so that
+    readers never see a partially written file.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_filename = tempfile.mkstemp(
+        prefix=os.path.basename(filename) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            write(file)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        try:
+            os.remove(temp_filename)
+        except OSError:
+            pass
+        raise
+
+
+def find_chessboard(img, pattern_size, keep_preview_img=False, scale=1.0,
+    use_sb=False):
+    """Find chessboard corners in a grayscale image and increase their
+    accuracy. Return a (corners, preview_img) tuple, corners are None if no
+    chessboard was found.
+
+    With scale < 1 the chessboard is searched for in a downscaled copy of the
+    image and the corners are refined in the full resolution one. With use_sb
+    cv.findChessboardCornersSB is used instead of cv.findChessboardCorners.
+    """
+    search_img = img
+    if scale != 1.0:
+        search_img = cv.resize(img, None, fx=scale, fy=scale,
+            interpolation=cv.INTER_AREA)
+
+    if use_sb:
+        ret, corners = cv.findChessboardCornersSB(search_img, pattern_size,
+            cv.CALIB_CB_NORMALIZE_IMAGE
+        )
+    else:
+        ret, corners = cv.findChessboardCorners(search_img, pattern_size,
+            cv.CALIB_CB_ADAPTIVE_THRESH
+            | cv.CALIB_CB_NORMALIZE_IMAGE 
+            | cv.CALIB_CB_FAST_CHECK
+        )
+    if not ret:
+        return None, None
+
+    if scale != 1.0:
+        # Map pixel centers back to the full resolution image
+        corners = ((corners + 0.5) / scale - 0.5).astype(np.float32)
+
+    # Increase the accuracy of corner points (already sub-pixel accurate if
+    # found by cv.findChessboardCornersSB in the full resolution image)
+    if scale != 1.0 or not use_sb:
+        corners = cv.cornerSubPix(img, corners, (11, 11), (-1, -1), 
+            (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+        )
+
+    # Create preview image if necessary
+    preview_img = None
+    if keep_preview_img:
+        img_rgb = np.repeat(img[:, :, np.newaxis], 3, axis=2)
+        preview_img = cv.drawChessboardCorners(img_rgb, pattern_size, corners,
+            True)
+
+    return corners, preview_img
+
+
+def find_chessboard_in_file(filename, pattern_size, **kwargs):
+    """Read a grayscale image and find a chessboard in it (see
+    find_chessboard()). Return a (corners, preview_img, size) tuple.
+    """
+    img = cv.imread(filename, cv.IMREAD_GRAYSCALE)
+    corners, preview_img = find_chessboard(img, pattern_size, **kwargs)
+    return corners, preview_img, (img.shape[1], img.shape[0])
+
+
+def project_points(obj_pts, rot_vecs, trans_vecs, matrix, dist_coeff):
+    """Project object points of all views at once. Obj_pts should have shape
+    (views, points, 3), rot_vecs and trans_vecs (views, 3). Supports up to 12
+    distortion coefficients (the tilted model is left to cv.projectPoints).
+    Return image points of shape (views, points, 2).
+    """
+    obj_pts = np.asarray(obj_pts, np.float64).reshape(len(rot_vecs), -1, 3)
+    rot_vecs = np.asarray(rot_vecs, np.float64).reshape(-1, 3)
+    trans_vecs = np.asarray(trans_vecs, np.float64).reshape(-1, 3)
+    dist = np.zeros(12)
+    dist_coeff = np.asarray(dist_coeff, np.float64).ravel()
+    if len(dist_coeff) > 12:
+        return np.stack([cv.projectPoints(pts, rvec, tvec, matrix,
+            dist_coeff)[0].reshape(-1, 2)
+            for pts, rvec, tvec in zip(obj_pts, rot_vecs, trans_vecs)])
+    dist[:len(dist_coeff)] = dist_coeff
+    k1, k2, p1, p2, k3, k4, k5, k6, s1, s2, s3, s4 = dist
+
+    # Rodrigues formula for all views
+    theta = np.linalg.norm(rot_vecs, axis=1)
+    axis = rot_vecs / np.where(theta > 1e-12, theta, 1)[:, np.newaxis]
+    k = np.zeros((len(axis), 3, 3))
+    k[:, 0, 1], k[:, 0, 2] = -axis[:, 2], axis[:, 1]
+    k[:, 1, 0], k[:, 1, 2] = axis[:, 2], -axis[:, 0]
+    k[:, 2, 0], k[:, 2, 1] = -axis[:, 1], axis[:, 0]
+    sin, cos = np.sin(theta)[:, None, None], np.cos(theta)[:, None, None]
+    rot = np.eye(3) + sin * k + (1 - cos) * (k @ k)
+
+    cam_pts = obj_pts @ rot.transpose(0, 2, 1) + trans_vecs[:, np.newaxis]
+    x = cam_pts[..., 0] / cam_pts[..., 2]
+    y = cam_pts[..., 1] / cam_pts[..., 2]
+
+    r2 = x * x + y * y
+    r4 = r2 * r2
+    radial = (1 + k1 * r2 + k2 * r4 + k3 * r4 * r2) \
+        / (1 + k4 * r2 + k5 * r4 + k6 * r4 * r2)
+    xd = x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x * x) \
+        + s1 * r2 + s2 * r4
+    yd = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * x * y \
+        + s3 * r2 + s4 * r4
+
+    matrix = np.asarray(matrix, np.float64)
+    u = matrix[0, 0] * xd + matrix[0, 1] * yd + matrix[0, 2]
+    v = matrix[1, 1] * yd + matrix[1, 2]
+    return np.stack((u, v), axis=-1)
+
+
+def reprojection_errors(obj_pts, img_pts, rot_vecs, trans_vecs, matrix,
+    dist_coeff):
+    """Return re-projection errors (distances in pixels) of every corner of
+    every view as an array of shape (views, points).
+    """
+    projected_pts = project_points(obj_pts, rot_vecs, trans_vecs, matrix,
+        dist_coeff)
+    img_pts = np.asarray(img_pts, np.float64).reshape(projected_pts.shape)
+    return np.linalg.norm(img_pts - projected_pts, axis=-1)
+
 
 class Calibration(ABC):
     @abstractmethod
@@ -21,27 +215,49 @@ class Calibration(ABC):
         
         self.width = None
         self.height = None
+
+        # Chessboard detection is run in a pool of workers if greater than 1,
+        # executor is "thread" or "process"
+        self.workers = None
+        self.executor = "thread"
+        self.progress_fn = None
+        # Chessboards are searched for in images downscaled by detection_scale,
+        # optionally with cv.findChessboardCornersSB
+        self.detection_scale = 1.0
+        self.detection_sb = False
+        # Path of a .npz file with corners found in image files or True for
+        # calibration_path/corners-cache.npz, None disables the cache
+        self.corner_cache = None
     
-    def _load_images(self, paths):
-        """Load set of images from the given paths."""
+    def _check_size(self, width, height):
+        """Set dimensions of images if not set already or check if they match."""
+        if self.width == None or self.height == None:
+            self.width, self.height = width, height
+        elif self.width != width or self.height != height:
+            raise CalibrationDimentionsNotMatch()
+
+    def _image_paths(self, paths):
+        """List image files in the given paths."""
         if not isinstance(paths, (tuple, list)):
             paths = (paths,)
 
-        groups = []
-        for path in paths:
-            images = []
-            for f in sorted(os.listdir(path)):
-                image = cv.imread(os.path.join(path, f))
-                image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
-                # Set dimenstions of images if not set already
-                if self.width == None or self.height == None:
-                    self.width, self.height = image.shape[1], image.shape[0]
-                elif self.width != image.shape[1] or \
-                    self.height != image.shape[0]:
-                    raise CalibrationDimentionsNotMatch()
-                    
-                images.append(image)
-            groups.append(images)
+        return [[os.path.join(path, f) for f in sorted(os.listdir(path))]
+                for path in paths]
+
+    def _load_images(self, paths, lazy=False):
+        """Load set of grayscale images from the given paths. If lazy, return
+        file paths instead, images are read one by one when searching for
+        chessboards then.
+        """
+        groups = self._image_paths(paths)
+        if lazy:
+            return groups
+
+        for images in groups:
+            for i, filename in enumerate(images):
+                image = cv.imread(filename, cv.IMREAD_GRAYSCALE)
+                self._check_size(image.shape[1], image.shape[0])
+                images[i] = image
         
         return groups
 
@@ -49,37 +265,72 @@ class Calibration(ABC):
     def load_images(self):
         pass
 
+    def _report_progress(self, done, total):
+        if self.progress_fn is not None:
+            self.progress_fn(done, total)
+        elif done == total or not done % max(1, total // 10):
+            logging.info("Processed {}/{} images.".format(done, total))
+
+    def _map(self, fn, items):
+        """Apply fn to every item serially or in a pool of workers, yield
+        results in the order of items and report progress.
+        """
+        executor = None
+        if self.workers is not None and self.workers > 1:
+            if self.executor == "process":
+                executor = ProcessPoolExecutor(self.workers)
+            else:
+                executor = ThreadPoolExecutor(self.workers)
+            results = executor.map(fn, items)
+        else:
+            results = map(fn, items)
+
+        try:
+            for done, result in enumerate(results, 1):
+                self._report_progress(done, len(items))
+                yield result
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
     def _find_chessboards(self, imgs, keep_preview_imgs=False, 
         return_nones=False):
-        """Find chessboards in the given images."""
+        """Find chessboards in the given images or image files. Files are read
+        only for the time of the search.
+        """
         img_pts = []
         preview_imgs = []
-        for img in imgs:
-            # Find chessboard corners
-            ret, corners = cv.findChessboardCorners(img, self.pattern_size,
-                cv.CALIB_CB_ADAPTIVE_THRESH
-                | cv.CALIB_CB_NORMALIZE_IMAGE 
-                | cv.CALIB_CB_FAST_CHECK
-            )
-            #
+        files = len(imgs) > 0 and isinstance(imgs[0], str)
+        if files:
+            find_fn = find_chessboard_in_file
+        else:
+            find_fn = find_chessboard
+        find_fn = functools.partial(find_fn,
+            pattern_size=self.pattern_size, keep_preview_img=keep_preview_imgs,
+            scale=self.detection_scale, use_sb=self.detection_sb)
+
+        # Preview images are not cached, so the cache cannot be used for them
+        if files and self.corner_cache is not None and not keep_preview_imgs:
+            results = self._find_chessboards_cached(find_fn, imgs)
+        else:
+            results = self._map(find_fn, imgs)
+
+        for result in results:
+            corners, preview_img = result[:2]
+            if len(result) > 2:
+                self._check_size(*result[2])
+
             # If no corners found, continue
-            if not ret:
+            if corners is None:
                 if return_nones:
                     img_pts.append(None)
                     if keep_preview_imgs:
                         preview_imgs.append(None)
                 continue
-            
-            # Increase the accuracy of corner points
-            corners = cv.cornerSubPix(img, corners, (11, 11), (-1, -1), 
-                (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-            )
 
             # Create preview images if necessary
             if keep_preview_imgs:
-                img_rgb = np.repeat(img[:, :, np.newaxis], 3, axis=2)
-                preview_imgs.append(cv.drawChessboardCorners(img_rgb,
-                    self.pattern_size, corners, True))
+                preview_imgs.append(preview_img)
 
             # Add chessboard points as image points
             img_pts.append(corners)
@@ -89,6 +340,74 @@ class Calibration(ABC):
 
         return img_pts, preview_imgs
 
+    def _corner_cache_path(self):
+        if self.corner_cache is True:
+            return os.path.join(self.calibration_path, "corners-cache.npz")
+        return self.corner_cache
+
+    def _corner_cache_key(self, filename):
+        """Return a key identifying an image file and detection settings."""
+        stat = os.stat(filename)
+        data = json.dumps([os.path.abspath(filename), stat.st_mtime_ns,
+            stat.st_size, list(self.pattern_size), self.detection_scale,
+            self.detection_sb])
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def _load_corner_cache(self):
+        """Load a dict {key: (corners, size)} from the corner cache file. An
+        unreadable cache is treated as empty.
+        """
+        path = self._corner_cache_path()
+        cache = {}
+        if not os.path.isfile(path):
+            return cache
+        try:
+            with np.load(path) as data:
+                for name in data.files:
+                    if name.endswith("_size"):
+                        continue
+                    corners = data[name]
+                    if corners.size == 0:
+                        corners = None
+                    cache[name] = (corners,
+                                   tuple(data[name + "_size"].tolist()))
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            logging.warning("Corner cache {} is unreadable, rebuilding it."
+                            .format(path), exc_info=True)
+            return {}
+        return cache
+
+    def _save_corner_cache(self, cache):
+        arrays = {}
+        for key, (corners, size) in cache.items():
+            if corners is None:
+                corners = np.zeros((0, 1, 2), np.float32)
+            arrays[key] = corners
+            arrays[key + "_size"] = np.array(size)
+        write_atomic(self._corner_cache_path(),
+                     lambda file: np.savez(file, **arrays))
+
+    def _find_chessboards_cached(self, find_fn, filenames):
+        """Find chessboards in image files which are not in the corner cache
+        yet and update the cache. Return results of find_fn for all files.
+        """
+        cache = self._load_corner_cache()
+        keys = [self._corner_cache_key(filename) for filename in filenames]
+        missing = [i for i, key in enumerate(keys) if key not in cache]
+        logging.info("Found {} of {} images in the corner cache.".format(
+            len(keys) - len(missing), len(keys)))
+
+        results = self._map(find_fn, [filenames[i] for i in missing])
+        for i, (corners, _, size) in zip(missing, results):
+            cache[keys[i]] = (corners, size)
+
+        # Keep only entries of the current files
+        cache = {key: cache[key] for key in keys}
+        if missing:
+            self._save_corner_cache(cache)
+
+        return [(corners, None, size) for corners, size in cache.values()]
+
     @abstractmethod
     def calibrate(self):
         pass
@@ -103,14 +422,13 @@ class Calibration(ABC):
 
     def _calculate_reprojection_error(self, obj_pts, img_pts, rot_vec,
         trans_vec, matrix, dist_coeff):
-        """Calculate re-projection error (requires calibration)."""
-        error = 0
-        for i in range(len(obj_pts)):
-            projected_img_pts, _ = cv.projectPoints(obj_pts[i], rot_vec[i], 
-                trans_vec[i], matrix, dist_coeff)
-            error += cv.norm(img_pts[i], projected_img_pts, cv.NORM_L2) \
-                / len(projected_img_pts)
-        return error / len(obj_pts)
+        """Calculate re-projection error (requires calibration): the mean over
+        views of the L2 norm of corner errors divided by the number of corners.
+        """
+        errors = reprojection_errors(obj_pts, img_pts, rot_vec, trans_vec,
+            matrix, dist_coeff)
+        return float(np.mean(np.sqrt((errors ** 2).sum(axis=1))
+            / errors.shape[1]))
 
     @abstractmethod
     def calculate_reprojection_error(self):
@@ -158,19 +476,26 @@ class Calibration2Cams(Calibration):
         self.right_proj = None
         self.left_roi = None
         self.right_roi = None
+        self.disparity_to_depth_matrix = None
 
         self.left_reprojection_error = None
         self.right_reprojection_error = None
+        self.rms_error = None
 
-    def load_images(self):
+        self.filename = None
+        self.maps = {}
+
+    def load_images(self, lazy=False):
         """Load set of corresponding left and right images from 
-           calibration_path/left and calibration_path/right.
+           calibration_path/left and calibration_path/right. If lazy, only
+           file paths are kept and every image is read, searched for
+           a chessboard and discarded by find_chessboards().
         """
         logging.info("Loading sets of corresponding left and right images "
             "from {}.".format(self.calibration_path))
         self.left_imgs, self.right_imgs = self._load_images([
             os.path.join(self.calibration_path, "left"),
-            os.path.join(self.calibration_path, "right")]
+            os.path.join(self.calibration_path, "right")], lazy
         )
         logging.info("Loaded {} pairs.".format(len(self.left_imgs)))
         if len(self.left_imgs) == 0:
@@ -180,13 +505,22 @@ class Calibration2Cams(Calibration):
     def find_chessboards(self, keep_chessboard_preview_imgs=False):
         # Get chessboard points as image points
         logging.info("Finding chessboard patterns in the images.")
-        left_img_pts, left_chessboard_preview_imgs = self._find_chessboards(
-            self.left_imgs, keep_chessboard_preview_imgs, True
-        )
-        right_img_pts, right_chessboard_preview_imgs = self._find_chessboards(
-            self.right_imgs, keep_chessboard_preview_imgs, True
+        # Left and right images are processed in one batch to share workers
+        img_pts, chessboard_preview_imgs = self._find_chessboards(
+            self.left_imgs + self.right_imgs, keep_chessboard_preview_imgs,
+            True
         )
+        left_img_pts = img_pts[:len(self.left_imgs)]
+        right_img_pts = img_pts[len(self.left_imgs):]
+        left_chessboard_preview_imgs = \
+            chessboard_preview_imgs[:len(self.left_imgs)]
+        right_chessboard_preview_imgs = \
+            chessboard_preview_imgs[len(self.left_imgs):]
         # Set only pairs with both valid images
+        self.left_img_pts = []
+        self.right_img_pts = []
+        self.left_chessboard_preview_imgs = []
+        self.right_chessboard_preview_imgs = []
         valid_pairs_cnt = 0
         for i in range(len(left_img_pts)):
             if (not left_img_pts[i] is None) and (not right_img_pts[i] is None):
@@ -202,6 +536,8 @@ class Calibration2Cams(Calibration):
         logging.info("Found chessboard patterns in {} pairs.".format(
             valid_pairs_cnt)
         )
+        if valid_pairs_cnt == 0:
+            raise NoCalibrationImages()
 
         # Set chessboard points as object points
         obj = np.zeros((self.pattern_size[0] * self.pattern_size[1], 3),
@@ -213,63 +549,59 @@ class Calibration2Cams(Calibration):
 
         return valid_pairs_cnt
     
-    def calibrate(self, load_images=False, keep_chessboard_preview_imgs=False):
-        """Perform a complete calibration process."""
+    def calibrate(self, load_images=False, keep_chessboard_preview_imgs=False,
+        lazy=False, target_rms=None, min_views=DEF_MIN_VIEWS):
+        """Perform a complete calibration process. See load_images() for
+           lazy loading, which is always used with a corner cache, and
+           calibrate_chessboards() for rejection of outlier views.
+        """
+        if self.corner_cache is not None:
+            lazy = True
+
         if load_images:
-            self.load_images()
+            self.load_images(lazy)
 
         if len(self.left_imgs) == 0:
             logging.warning("No calibration images loaded.")
-            self.load_images()
+            self.load_images(lazy)
 
         if len(self.left_imgs) != len(self.right_imgs):
             raise CalibrationImagesNotMatch()
 
         self.find_chessboards(keep_chessboard_preview_imgs)
+        self.calibrate_chessboards(target_rms, min_views)
 
-        logging.info("Calibrating left camera.")
-        _, left_matrix, left_dist_coeff, left_rot_vec, left_trans_vec = \
-            cv.calibrateCamera(self.obj_pts, self.left_img_pts,
-            (self.width, self.height), None, None
-        )
-        self.left_matrix = left_matrix
-        self.left_dist_coeff = left_dist_coeff
-        self.left_rot_vec = left_rot_vec
-        self.left_trans_vec = left_trans_vec
-
-        logging.info("Calibrating right camera.")
-        _, right_matrix, right_dist_coeff, right_rot_vec, right_trans_vec = \
-            cv.calibrateCamera(self.obj_pts, self.right_img_pts,
-            (self.width, self.height), None, None
-        )
-        self.right_matrix = right_matrix
-        self.right_dist_coeff = right_dist_coeff
-        self.right_rot_vec = right_rot_vec
-        self.right_trans_vec = right_trans_vec
+    def calibrate_chessboards(self, target_rms=None, min_views=DEF_MIN_VIEWS,
+        drop_views=1):
+        """Calibrate cameras using already found chessboards.
 
-        logging.info("Calibrating both cameras.")
-        _, _, _, _, _, rot_matrix, trans_vec, _, _ = cv.stereoCalibrate(
-            self.obj_pts,
-            self.left_img_pts, self.right_img_pts,
-            self.left_matrix, self.left_dist_coeff,
-            self.right_matrix, self.right_dist_coeff,
-            (self.width, self.height), None, None, None, None,
-            cv.CALIB_FIX_INTRINSIC,
-            (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-        )
-        self.both_rot_matrix = rot_matrix
-        self.both_trans_vec = trans_vec
+        If target_rms is given, views are rejected iteratively: drop_views
+        views with the greatest per-view error are removed and the calibration
+        is repeated, starting from the previous solution, until the stereo RMS
+        error is not greater than target_rms or only min_views views are left.
+        """
+        guess = False
+        while True:
+            rms, view_errors = self._calibrate_views(guess)
+            if target_rms is None or rms <= target_rms:
+                break
+            if len(self.obj_pts) - drop_views < min_views:
+                logging.warning("Stereo RMS error {:.4f} is above the target "
+                    "{} but only {} views are left.".format(
+                    rms, target_rms, len(self.obj_pts)))
+                break
+            worst = [int(i) for i in np.argsort(view_errors)[-drop_views:]]
+            logging.info("Stereo RMS error {:.4f}, removing views {}."
+                .format(rms, sorted(worst)))
+            self.remove_views(worst)
+            guess = True
+        self.rms_error = rms
+        self.maps = {}
 
         logging.info("Rectifying cameras.")
         self.left_rectif, self.right_rectif, self.left_proj, self.right_proj, \
-            _, self.left_roi, self.right_roi = cv.stereoRectify(
-                self.left_matrix, self.left_dist_coeff,
-                self.right_matrix, self.right_dist_coeff,
-                (self.width, self.height), 
-                self.both_rot_matrix, self.both_trans_vec,
-                None, None, None, None, None,
-                cv.CALIB_ZERO_DISPARITY, 0.25
-        )
+            self.disparity_to_depth_matrix, self.left_roi, self.right_roi = \
+            self._rectify()
 
         self.calibrated = True
 
@@ -281,6 +613,64 @@ class Calibration2Cams(Calibration):
             self.right_reprojection_error)
         )
 
+    def _calibrate_views(self, guess=False):
+        """Run calibration of both cameras and the stereo calibration. With
+        guess, the current parameters are used as the initial solution.
+        Return the stereo RMS error and the greatest error of each view.
+        """
+        size = (self.width, self.height)
+        flags = cv.CALIB_USE_INTRINSIC_GUESS if guess else 0
+
+        logging.info("Calibrating left camera.")
+        _, self.left_matrix, self.left_dist_coeff, self.left_rot_vec, \
+            self.left_trans_vec, _, _, left_errors = \
+            cv.calibrateCameraExtended(self.obj_pts, self.left_img_pts, size,
+            self.left_matrix if guess else None,
+            self.left_dist_coeff if guess else None, flags=flags
+        )
+
+        logging.info("Calibrating right camera.")
+        _, self.right_matrix, self.right_dist_coeff, self.right_rot_vec, \
+            self.right_trans_vec, _, _, right_errors = \
+            cv.calibrateCameraExtended(self.obj_pts, self.right_img_pts, size,
+            self.right_matrix if guess else None,
+            self.right_dist_coeff if guess else None, flags=flags
+        )
+
+        logging.info("Calibrating both cameras.")
+        flags = cv.CALIB_FIX_INTRINSIC
+        if guess:
+            flags |= cv.CALIB_USE_EXTRINSIC_GUESS
+        # Newer OpenCV versions also return per-view rvecs and tvecs, so take
+        # the errors from the end
+        result = cv.stereoCalibrateExtended(
+            self.obj_pts,
+            self.left_img_pts, self.right_img_pts,
+            self.left_matrix, self.left_dist_coeff,
+            self.right_matrix, self.right_dist_coeff, size,
+            self.both_rot_matrix if guess else None,
+            self.both_trans_vec if guess else None,
+            flags=flags,
+            criteria=(cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30,
+                0.001)
+        )
+        rms = result[0]
+        self.both_rot_matrix, self.both_trans_vec = result[5], result[6]
+
+        view_errors = np.hstack([left_errors, right_errors, result[-1]])
+        return rms, view_errors.max(axis=1)
+
+    def _rectify(self):
+        """Call cv.stereoRectify() with calibrated parameters."""
+        return cv.stereoRectify(
+            self.left_matrix, self.left_dist_coeff,
+            self.right_matrix, self.right_dist_coeff,
+            (self.width, self.height), 
+            self.both_rot_matrix, self.both_trans_vec,
+            None, None, None, None, None,
+            cv.CALIB_ZERO_DISPARITY, 0.25
+        )
+
     def get_dict(self, numpy2list=False):
         """Return a dict with important calibration parameters."""
         params = {
@@ -299,6 +689,7 @@ class Calibration2Cams(Calibration):
             "right_reprojection_error":self.right_reprojection_error,
             "both_rot_matrix":self.both_rot_matrix,
             "both_trans_vec":self.both_trans_vec,
+            "disparity_to_depth_matrix":self.disparity_to_depth_matrix,
             "width":self.width,
             "height":self.height,
         }
@@ -308,32 +699,169 @@ class Calibration2Cams(Calibration):
                     params[key] = value.tolist()
         return params
 
-    def save(self, filename, format="json"):
-        """Save important calibration parameters to the specified file."""
+    def get_hash(self, *extra):
+        """Return a hex digest identifying the calibration parameters (and any
+        extra values like a target size), e.g. to key cached data.
+        """
+        params = self.get_dict(True)
+        for key, value in params.items():
+            if isinstance(value, tuple):
+                params[key] = list(value)
+        data = json.dumps([params, list(extra)], sort_keys=True, default=str)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    @staticmethod
+    def _file_format(filename):
+        """Return the format of a calibration file given by its extension.
+        YAML files written by cv.FileStorage start with a %YAML directive.
+        """
+        format = _FORMATS.get(os.path.splitext(filename)[1].lower(), "json")
+        if format == "yaml" and os.path.isfile(filename):
+            with open(filename, "r") as file:
+                if file.readline().startswith("%YAML"):
+                    format = "opencv"
+        return format
+
+    def rectification_maps(self, size=None):
+        """Return float rectification maps (left_map_x, left_map_y,
+        right_map_x, right_map_y) for images of the given size (calibration
+        size by default). Maps embedded in a loaded .npz file are not computed
+        again.
+        """
+        if not self.calibrated:
+            raise NotCalibrated()
+        if size is None:
+            size = (self.width, self.height)
+        size = (int(size[0]), int(size[1]))
+        if size in self.maps:
+            return self.maps[size]
+
+        scale = size[0] / self.width
+        left_proj = np.array(self.left_proj, dtype=np.float64)
+        right_proj = np.array(self.right_proj, dtype=np.float64)
+        left_proj[:2] *= scale
+        right_proj[:2] *= scale
+
+        left_map_x, left_map_y = cv.initUndistortRectifyMap(
+            self.left_matrix, self.left_dist_coeff, self.left_rectif,
+            left_proj, size, cv.CV_32FC1
+        )
+        right_map_x, right_map_y = cv.initUndistortRectifyMap(
+            self.right_matrix, self.right_dist_coeff, self.right_rectif,
+            right_proj, size, cv.CV_32FC1
+        )
+        return left_map_x, left_map_y, right_map_x, right_map_y
+
+    def save(self, filename, format=None, map_sizes=()):
+        """Save important calibration parameters to the specified file. The
+        format ("json", "yaml", "npz" or "opencv" for cv.FileStorage) is
+        chosen by the file extension if not given. The binary .npz format
+        can also hold rectification maps for each of map_sizes.
+        """
         logging.info("Saving important calibration parameters to {}."
             .format(filename)
         )
-        params = self.get_dict(True)
-        
-        with open(filename, "w") as file:
-            if format == "yaml":
-                yaml.dump(params, file)
-            else:
-                json.dump(params, file)
+        if format is None:
+            format = self._file_format(filename)
+
+        if format == "npz":
+            params = self._save_npz(filename, map_sizes)
+        elif format == "opencv":
+            params = self._save_file_storage(filename)
+        else:
+            params = self.get_dict(True)
+            with open(filename, "w") as file:
+                if format == "yaml":
+                    yaml.dump(params, file)
+                else:
+                    json.dump(params, file)
+        self.filename = filename
             
         return params
 
+    def _save_npz(self, filename, map_sizes=()):
+        params = self.get_dict()
+        arrays = {key: np.asarray(value) for key, value in params.items()
+                  if value is not None}
+        for size in map_sizes:
+            maps = self.rectification_maps(size)
+            for name, map in zip(_MAP_NAMES, maps):
+                arrays["maps.{}x{}.{}".format(*size, name)] = map
+        with open(filename, "wb") as file:
+            np.savez(file, **arrays)
+        return params
+
+    def _load_npz(self, filename):
+        params = {}
+        maps = {}
+        for key, value in load_npz(filename).items():
+            if key.startswith("maps."):
+                _, size, name = key.split(".")
+                size = tuple(int(x) for x in size.split("x"))
+                maps.setdefault(size, {})[name] = value
+            elif value.ndim == 0:
+                params[key] = value.item()
+            elif key.endswith("_roi"):
+                params[key] = tuple(int(x) for x in value)
+            else:
+                params[key] = value
+        self.maps = {size: tuple(names[name] for name in _MAP_NAMES)
+                     for size, names in maps.items()}
+        return params
+
+    def _save_file_storage(self, filename):
+        params = self.get_dict()
+        storage = cv.FileStorage(filename, cv.FILE_STORAGE_WRITE)
+        for key, value in params.items():
+            if value is None:
+                continue
+            if isinstance(value, (tuple, list)):
+                value = np.array(value)
+            elif isinstance(value, (bool, np.bool_)):
+                value = int(value)
+            storage.write(key, value)
+        storage.release()
+        return params
+
+    def _load_file_storage(self, filename):
+        params = {}
+        storage = cv.FileStorage(filename, cv.FILE_STORAGE_READ)
+        for key in self.get_dict():
+            node = storage.getNode(key)
+            if node.empty():
+                continue
+            if node.isMap():
+                params[key] = node.mat()
+            elif node.isInt():
+                params[key] = int(node.real())
+            else:
+                params[key] = node.real()
+            if key.endswith("_roi"):
+                params[key] = tuple(int(x) for x in params[key].ravel())
+        storage.release()
+        params["calibrated"] = bool(params.get("calibrated"))
+        return params
+
     def load(self, filename):
-        """Load important calibration parameters from the specified file."""
+        """Load important calibration parameters from the specified file
+        (JSON, YAML, .npz or cv.FileStorage XML/YAML).
+        """
         logging.info("Loading important calibration parameters {}"
             .format(filename)
         )
         
-        with open(filename, "r") as file:
-            params = yaml.load(file)
-
-        for value in params.values():
-            if value is None:
+        self.maps = {}
+        format = self._file_format(filename)
+        if format == "npz":
+            params = self._load_npz(filename)
+        elif format == "opencv":
+            params = self._load_file_storage(filename)
+        else:
+            with open(filename, "r") as file:
+                params = yaml.load(file, Loader=CalibrationLoader)
+
+        for key in self.get_dict():
+            if key != "disparity_to_depth_matrix" and params.get(key) is None:
                 raise NotCalibrated()
 
         for key, value in params.items():
@@ -357,6 +885,12 @@ class Calibration2Cams(Calibration):
         self.both_trans_vec = params["both_trans_vec"]
         self.width = params["width"]
         self.height = params["height"]
+        self.filename = filename
+
+        # Files saved before the matrix was stored do not contain it
+        if params.get("disparity_to_depth_matrix") is None:
+            params["disparity_to_depth_matrix"] = self._rectify()[4]
+        self.disparity_to_depth_matrix = params["disparity_to_depth_matrix"]
 
         return params
 
@@ -385,6 +919,65 @@ class Calibration2Cams(Calibration):
 
         return left_reprojection_error, right_reprojection_error
 
+    def reprojection_report(self):
+        """Return per-view and per-corner re-projection errors for both cameras
+        (requires calibration) as a dict with "left_rms", "right_rms" and
+        "rms" (the worse camera) arrays of shape (views,) and "left_corners",
+        "right_corners" arrays of shape (views, points).
+        """
+        if not self.calibrated or self.left_rot_vec is None \
+            or self.right_rot_vec is None:
+            raise NotCalibrated()
+
+        left_corners = reprojection_errors(self.obj_pts, self.left_img_pts,
+            self.left_rot_vec, self.left_trans_vec, self.left_matrix,
+            self.left_dist_coeff)
+        right_corners = reprojection_errors(self.obj_pts, self.right_img_pts,
+            self.right_rot_vec, self.right_trans_vec, self.right_matrix,
+            self.right_dist_coeff)
+        left_rms = np.sqrt((left_corners ** 2).mean(axis=1))
+        right_rms = np.sqrt((right_corners ** 2).mean(axis=1))
+
+        return {
+            "left_rms": left_rms,
+            "right_rms": right_rms,
+            "rms": np.maximum(left_rms, right_rms),
+            "left_corners": left_corners,
+            "right_corners": right_corners,
+        }
+
+    def find_outlier_views(self, max_rms=None):
+        """Return indices of views with per-view RMS error (of the worse
+        camera) greater than max_rms or, if not given, greater than the median
+        plus three scaled median absolute deviations.
+        """
+        rms = self.reprojection_report()["rms"]
+        if max_rms is None:
+            median = np.median(rms)
+            max_rms = median + 3 * 1.4826 * np.median(np.abs(rms - median))
+        return [int(i) for i in np.flatnonzero(rms > max_rms)]
+
+    def remove_views(self, indices):
+        """Remove chessboard views (pairs of image points) with the given
+        indices. Call calibrate_chessboards() to re-run the calibration.
+        """
+        indices = set(indices)
+        keep = [i for i in range(len(self.obj_pts)) if i not in indices]
+        self.obj_pts = [self.obj_pts[i] for i in keep]
+        self.left_img_pts = [self.left_img_pts[i] for i in keep]
+        self.right_img_pts = [self.right_img_pts[i] for i in keep]
+        if self.left_chessboard_preview_imgs:
+            self.left_chessboard_preview_imgs = [
+                self.left_chessboard_preview_imgs[i] for i in keep]
+            self.right_chessboard_preview_imgs = [
+                self.right_chessboard_preview_imgs[i] for i in keep]
+        for name in ("left_rot_vec", "left_trans_vec", "right_rot_vec",
+            "right_trans_vec"):
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, [value[i] for i in keep])
+        return len(keep)
+
     def undistort_left(self, img, crop=True):
         """Undistort image captured by left camera (requires calibration)."""
         if not self.calibrated:
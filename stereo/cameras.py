@@ -1,11 +1,18 @@
 from .exceptions import CameraCaptureError
+from .grabber import (DEF_BUFFER_SIZE, FrameGrabber, Timestamp,
+                      grab_timestamp, has_shared_clock)
+from .metrics import Metrics
+from .probe import DEF_PROBE_TIMEOUT, probe_cameras
+from .sync import DEF_MAX_REJECTED, SkewStats, match_frames, skew
+from .transforms import TransformChain, to_gray
 import cv2 as cv
-import numpy as np
+import logging
 import platform
 import sys
 import io
 import IPython
 import PIL.Image
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 DEF_IDS = [0]
@@ -15,6 +22,21 @@ DEF_SIZE = (DEF_WIDTH, DEF_HEIGHT)
 DEF_FPS = 30
 DEF_MODE = 3
 
+_TO_GRAY = ((cv.cvtColor, cv.COLOR_BGR2GRAY),)
+_TO_RGB = ((cv.cvtColor, cv.COLOR_BGR2RGB),)
+_GRAY_TO_RGB = ((cv.cvtColor, cv.COLOR_GRAY2RGB),)
+
+# Raw V4L2 formats whose luma is extracted in the gray mode: packed YUV 4:2:2,
+# formats starting with the full luma plane and JPEG (decoded in grayscale)
+_PACKED_YUV = {
+    cv.VideoWriter_fourcc(*"YUYV"): cv.COLOR_YUV2GRAY_YUY2,
+    cv.VideoWriter_fourcc(*"YUY2"): cv.COLOR_YUV2GRAY_YUY2,
+    cv.VideoWriter_fourcc(*"UYVY"): cv.COLOR_YUV2GRAY_UYVY,
+}
+_LUMA_FIRST = {cv.VideoWriter_fourcc(*fourcc) for fourcc in
+               ("GREY", "Y800", "NV12", "NV21", "YU12", "YV12")}
+_JPEG = {cv.VideoWriter_fourcc(*"MJPG"), cv.VideoWriter_fourcc(*"JPEG")}
+
 _platform = platform.system()
 if _platform == "Windows":
     # DEF_API = cv.CAP_DSHOW # Weird errors with messed up image array
@@ -31,7 +53,11 @@ else:
 class Cameras:
     def __init__(self, devices=DEF_IDS, size=DEF_SIZE, fps=DEF_FPS,
                  mode=DEF_MODE, transformations=None, api=DEF_API,
-                 print_date=False):
+                 print_date=False, threaded=False,
+                 buffer_size=DEF_BUFFER_SIZE, sync_tolerance=None,
+                 metrics=None, parallel_transform=True, gray=False,
+                 fourcc=None, max_rejected=DEF_MAX_REJECTED,
+                 exact_transform=True):
         if not isinstance(devices, list):
             self.devices = [devices, ]
         else:
@@ -42,17 +68,40 @@ class Cameras:
         self.mode = mode
         self.api = api
         self.print_date = print_date
+        self.threaded = threaded
+        self.buffer_size = buffer_size
+        self.parallel_transform = parallel_transform
+        # If False, transformations may be reordered at the cost of rounding
+        self.exact_transform = exact_transform
+        # Grayscale frames are captured without decoding to BGR if possible
+        self.gray = gray
+        self.fourcc = fourcc
+        self.skew_stats = SkewStats(sync_tolerance)
+        self.max_rejected = max_rejected
+        # Stage timings are not collected unless a Metrics object is given
+        if metrics is None:
+            self.metrics = Metrics(enabled=False)
+        else:
+            self.metrics = metrics
         if transformations is None:
             self.transformations = []
         else:
             self.transformations = transformations
 
-        self.frames = []
-        for _ in range(len(self.devices)):
-            self.frames.append(
-                np.zeros((self.height, self.width, 3), dtype=np.uint8))
+        self._captures = None
+        self.grabbers = []
+        self._chains = {}
+        self._executor = None
+        self._shared_clock = None
+        # (camera, fourcc, width, height) of captures returning raw frames
+        self._raw_formats = {}
 
-        self.transform()
+        # Placeholders are shaped like transformed frames
+        self.timestamps = [None] * len(self.devices)
+        self.frames = []
+        shape = (self.height, self.width) if gray else (self.height, self.width, 3)
+        for chain in self._get_chains():
+            self.frames.append(chain.placeholder(shape))
 
     @staticmethod
     def list_backends():
@@ -63,29 +112,31 @@ class Cameras:
         return backends
 
     @staticmethod
-    def list_cams():
-        """Brute-force camera device indices and return a list of available ones."""
-        cams = []
-        for i in range(32):
-            cam = cv.VideoCapture(i)
-            ret, _ = cam.read()
-            if not ret:
-                continue
-            cams.append(i)
-        return cams
+    def list_cams(timeout=DEF_PROBE_TIMEOUT):
+        """Return a list of available camera device indices. See
+        probe_cameras() for their supported formats.
+        """
+        return [camera.index for camera in probe_cameras(timeout)]
 
     def to_csi_device(self):
-        """Convert the camera name to CSI device value."""
+        """Convert the camera name to CSI device value. In the gray mode the
+        hardware converter outputs the luma plane (GRAY8) directly, otherwise
+        BGRx is converted to BGR on the CPU.
+        """
+        if self.gray:
+            output = "video/x-raw, width=(int)%d, height=(int)%d, " \
+                     "format=(string)GRAY8 ! appsink"
+        else:
+            output = "video/x-raw, width=(int)%d, height=(int)%d, " \
+                     "format=(string)BGRx ! videoconvert ! " \
+                     "video/x-raw, format=(string)BGR ! appsink"
         for idx, device in enumerate(self.devices):
             self.devices[idx] = (
-                "nvarguscamerasrc sensor-id=%d sensor-mode=%d ! "
+                ("nvarguscamerasrc sensor-id=%d sensor-mode=%d ! "
                 "video/x-raw(memory:NVMM), "
                 "width=(int)%d, height=(int)%d, "
                 "format=(string)NV12, framerate=(fraction)%d/1 ! "
-                "nvvidconv flip-method=%d ! "
-                "video/x-raw, width=(int)%d, height=(int)%d, format=(string)BGRx ! "
-                "videoconvert ! "
-                "video/x-raw, format=(string)BGR ! appsink"
+                "nvvidconv flip-method=%d ! " + output)
                 % (
                     device,  # camera id
                     self.mode,  # mode
@@ -98,79 +149,213 @@ class Cameras:
                 )
             )
 
-    def transform(self):
+    def _get_chains(self, extra=()):
+        """Return transformation chains (one per device) compiled from the
+        current transformations followed by the extra ones.
+        """
+        transformations = list(self.transformations) + list(extra)
+        cached = self._chains.get(extra)
+        if cached is None or len(cached[0]) != len(transformations) or any(
+                a is not b for a, b in zip(cached[0], transformations)):
+            chains = [TransformChain(transformations,
+                                     exact=self.exact_transform)
+                      for _ in self.devices]
+            cached = self._chains[extra] = (transformations, chains)
+        return cached[1]
+
+    def transform(self, extra=()):
         """For each frame apply given transformations which should be a list
         like that: [function, arg1, arg2, ...]. Each transformation function has
-        to return a new image. Transformations are executed one by one.
+        to return a new image. Transformations are executed one by one, but
+        common OpenCV operations are merged, reordered and reuse buffers (see
+        TransformChain, exact_transform=False allows reordering which may
+        change pixel values by rounding). With parallel_transform, frames of
+        all devices are transformed in parallel.
         """
-        for i in range(len(self.frames)):
-            for transformation in self.transformations:
-                function = transformation[0]
-                if len(transformation) > 1:
-                    args = transformation[1:]
-                else:
-                    args = []
-                # function(self.frames[i], *args, dst=self.frames[i])
-                self.frames[i] = function(self.frames[i], *args)
+        chains = self._get_chains(extra)
+        if not chains or not chains[0].steps:
+            return
+
+        if self.parallel_transform and len(chains) > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(len(chains))
+            self.frames[:] = self._executor.map(
+                lambda chain, frame: chain(frame), chains, self.frames)
+        else:
+            for i, chain in enumerate(chains):
+                self.frames[i] = chain(self.frames[i])
 
     def capture_black_screen(self):
         """Make all frames black."""
         for frame in self.frames:
             frame.fill(0)
 
-    def capture(self):
-        """Call cv.VideoCapture() for each device, transform recieved images and
-        return as a list of numpy arrays.
+    def _open_capture(self, device):
+        """Open a single device and set the requested frame size. In the gray
+        mode V4L2 devices are asked for raw frames (in the given fourcc) which
+        are not converted to BGR, unless the luma of their format cannot be
+        extracted.
+        """
+        camera = cv.VideoCapture(device)
+        camera.set(cv.CAP_PROP_FRAME_WIDTH, self.width)
+        camera.set(cv.CAP_PROP_FRAME_HEIGHT, self.height)
+        if self.fourcc is not None:
+            camera.set(cv.CAP_PROP_FOURCC, cv.VideoWriter_fourcc(*self.fourcc))
+        if self.gray and camera.isOpened() \
+                and camera.getBackendName() == "V4L2":
+            fourcc = int(camera.get(cv.CAP_PROP_FOURCC))
+            if fourcc in _PACKED_YUV or fourcc in _LUMA_FIRST \
+                    or fourcc in _JPEG:
+                camera.set(cv.CAP_PROP_CONVERT_RGB, 0)
+                # Read once, the handle may be in use by a grabber thread later
+                self._raw_formats[id(camera)] = (
+                    camera, fourcc, int(camera.get(cv.CAP_PROP_FRAME_WIDTH)),
+                    int(camera.get(cv.CAP_PROP_FRAME_HEIGHT)))
+        return camera
+
+    def _release_capture(self, camera):
+        self._raw_formats.pop(id(camera), None)
+        camera.release()
+
+    def _to_gray(self, camera, frame):
+        """Extract the luma of a frame retrieved in the gray mode. Raw V4L2
+        frames are packed YUV 4:2:2 (2 channels), the luma plane followed by
+        chroma (1.5 times taller) or a JPEG image in a single row of bytes,
+        which is decoded in grayscale only. Other frames are BGR.
+        """
+        raw_format = self._raw_formats.get(id(camera))
+        if raw_format is None:
+            return to_gray(frame)
+
+        _, fourcc, width, height = raw_format
+        if fourcc in _JPEG:
+            frame = cv.imdecode(frame, cv.IMREAD_GRAYSCALE)
+            if frame is None:
+                raise CameraCaptureError("Unable to decode image from cam",
+                                         camera)
+            return frame
+        if frame.ndim == 2 and frame.shape[0] == 1:
+            # Whole buffer in a single row (older OpenCV versions)
+            if fourcc in _PACKED_YUV:
+                frame = frame[0, :width * height * 2].reshape(height, width, 2)
+            else:
+                frame = frame[0, :width * height].reshape(height, width)
+        if fourcc in _PACKED_YUV:
+            return cv.cvtColor(frame, _PACKED_YUV[fourcc])
+        return frame[:height]
+
+    @property
+    def is_open(self):
+        """True if devices are kept open between captures (see open())."""
+        return self._captures is not None
+
+    def open(self, prewarm=0):
+        """Open all devices and keep them open until close() is called, so that
+        capture() and stream() do not have to set up the capture pipelines
+        again. Optionally grab and discard `prewarm` frames from each device
+        to let exposure and driver queues settle.
         """
-        cameras = []
+        if self.is_open:
+            return self
+
+        self._captures = []
         for device in self.devices:
-            camera = cv.VideoCapture(device)
-            camera.set(cv.CAP_PROP_FRAME_WIDTH, self.width)
-            camera.set(cv.CAP_PROP_FRAME_HEIGHT, self.height)
-            cameras.append(camera)
-
-        for camera in cameras:
-            ret = camera.grab()
-            if not ret:
-                for c in cameras:
-                    c.release()
-                raise CameraCaptureError(
-                    "Unable to grab image from cam", camera)
-
-        for idx, camera in enumerate(cameras):
-            ret, self.frames[idx] = camera.retrieve()
-            if not ret:
-                for c in cameras:
-                    c.release()
-                raise CameraCaptureError(
-                    "Unable to retrieve image from cam", camera)
-            elif self.print_date:
-                self.frames[idx] = self.write_date(self.frames[idx])
-
-        for camera in cameras:
-            camera.release()
-
-        self.transform()
+            camera = self._open_capture(device)
+            self._captures.append(camera)
+            if not camera.isOpened():
+                self.close()
+                raise CameraCaptureError("Unable to open cam", device)
+
+        for _ in range(prewarm):
+            for camera in self._captures:
+                camera.grab()
+
+        return self
+
+    def close(self):
+        """Release all devices opened by open() and the transformation
+        threads.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if not self.is_open:
+            return
+        for camera in self._captures:
+            self._release_capture(camera)
+        self._captures = None
+        self.grabbers = []
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _read(self, cameras):
+        """Grab a frame from every camera first and then retrieve them, so that
+        the frames are as close in time as possible. Return False if the skew
+        between the frames exceeds the sync tolerance.
+        """
+        with self.metrics.measure("grab"):
+            for idx, camera in enumerate(cameras):
+                ret = camera.grab()
+                if not ret:
+                    raise CameraCaptureError(
+                        "Unable to grab image from cam", camera)
+                self.timestamps[idx] = grab_timestamp(camera,
+                                                      self._shared_clock)
+
+        with self.metrics.measure("retrieve"):
+            for idx, camera in enumerate(cameras):
+                ret, frame = camera.retrieve()
+                if not ret:
+                    raise CameraCaptureError(
+                        "Unable to retrieve image from cam", camera)
+                if self.gray:
+                    frame = self._to_gray(camera, frame)
+                if self.print_date:
+                    frame = self.write_date(frame)
+                self.frames[idx] = frame
+
+        return self.skew_stats.update(skew(self.timestamps))
+
+    def capture(self):
+        """Capture a frame from each device, transform recieved images and
+        return as a list of numpy arrays. If the devices were not opened with
+        open(), they are opened and released within this call.
+        """
+        return self._capture()
+
+    def _capture(self, extra=()):
+        if self.is_open:
+            cameras = self._captures
+        else:
+            cameras = [self._open_capture(device) for device in self.devices]
+
+        try:
+            self._read(cameras)
+        finally:
+            if cameras is not self._captures:
+                for camera in cameras:
+                    self._release_capture(camera)
+
+        self.transform(extra)
 
         return self.frames
 
     def capture_rgb(self):
         """Do the same what capture() but after all transformations convert colors
-        to RGB.
+        to RGB (as a part of the transformation chain).
         """
-        self.capture()
-        for i in range(len(self.frames)):
-            self.frames[i] = cv.cvtColor(self.frames[i], cv.COLOR_BGR2RGB)
-        return self.frames
+        return self._capture(_GRAY_TO_RGB if self.gray else _TO_RGB)
 
     def capture_gray(self):
         """Do the same what capture() but after all transformations convert colors
-        to grayscale.
+        to grayscale (as a part of the transformation chain). In the gray mode
+        frames are already grayscale.
         """
-        self.capture()
-        for i in range(len(self.frames)):
-            self.frames[i] = cv.cvtColor(self.frames[i], cv.COLOR_BGR2GRAY)
-        return self.frames
+        return self._capture(() if self.gray else _TO_GRAY)
 
     @staticmethod
     def write_date(frame):
@@ -191,11 +376,14 @@ class Cameras:
 
     def nshow(self):
         """Show all frames using Jupyter Notebook cell output. Apply the
-           conversion from BGR to RGB before.
+           conversion from BGR (or grayscale) to RGB before.
         """
         frames = self.frames.copy()
         for frame in frames:
-            frame = cv.cvtColor(frame, cv.COLOR_BGR2RGB)
+            if frame.ndim == 2:
+                frame = cv.cvtColor(frame, cv.COLOR_GRAY2RGB)
+            else:
+                frame = cv.cvtColor(frame, cv.COLOR_BGR2RGB)
             IPython.display.display(PIL.Image.fromarray(frame))
 
     def _stream_update(self):
@@ -209,47 +397,91 @@ class Cameras:
     def _stream_cleanup(self):
         cv.destroyAllWindows()
 
+    def _read_grabbers(self):
+        """Take the best matching set of frames from the background grabbers.
+        Return None if the grabbers have stopped and False if the skew between
+        the frames exceeds the sync tolerance.
+        """
+        matched = match_frames(self.grabbers)
+        if matched is None:
+            return None
+        frames, frames_skew = matched
+        for idx, frame in enumerate(frames):
+            image = frame.image
+            # Frames dropped by the grabbers are never decoded
+            if self.gray:
+                image = self._to_gray(self.grabbers[idx].camera, image)
+            if self.print_date:
+                image = self.write_date(image)
+            self.frames[idx] = image
+            self.timestamps[idx] = Timestamp(frame.timestamp, frame.pos_msec)
+        return self.skew_stats.update(frames_skew)
+
+    def grabber_stats(self):
+        """Return frame counters of the background grabbers used by the last
+        threaded stream.
+        """
+        return [grabber.stats() for grabber in self.grabbers]
+
     def stream(self, update_fn=_stream_update, cleanup_fn=_stream_cleanup):
-        cameras = []
-        for device in self.devices:
-            camera = cv.VideoCapture(device)
-            camera.set(cv.CAP_PROP_FRAME_WIDTH, self.width)
-            camera.set(cv.CAP_PROP_FRAME_HEIGHT, self.height)
-            cameras.append(camera)
+        """Capture frames continuously and call update_fn after each set of
+        frames until it returns False. If the cameras were created with
+        threaded=True, every device is drained by its own background thread
+        and update_fn always gets the freshest frames. Sets of frames with
+        skew greater than sync_tolerance are not passed to update_fn, unless
+        max_rejected sets in a row were rejected (then the set is passed with
+        a warning, so that update_fn can still stop the stream). Stage timings
+        and the capture frame rate are collected in self.metrics.
+        """
+        if self.is_open:
+            cameras = self._captures
+        else:
+            cameras = [self._open_capture(device) for device in self.devices]
+        self._shared_clock = all(has_shared_clock(camera)
+                                 for camera in cameras)
+
+        if self.threaded:
+            self.grabbers = [FrameGrabber(camera, self.buffer_size,
+                                          self.metrics)
+                             for camera in cameras]
+            for grabber in self.grabbers:
+                grabber.start()
 
         running = True
         try:
             while running:
-                for camera in cameras:
-                    ret = camera.grab()
-                    if not ret:
-                        for c in cameras:
-                            c.release()
-                        raise CameraCaptureError(
-                            "Unable to grab image from cam", camera
-                        )
-
-                for idx, camera in enumerate(cameras):
-                    ret, frame = camera.retrieve()
-                    if not ret:
-                        for c in cameras:
-                            c.release()
-                        raise CameraCaptureError(
-                            "Unable to retrieve image from cam", camera
-                        )
-                    elif self.print_date:
-                        frame = self.write_date(frame)
-                    self.frames[idx] = frame
-
-                self.transform()
-
-                if update_fn(self) == False:
-                    running = False
+                if self.threaded:
+                    with self.metrics.measure("sync"):
+                        synced = self._read_grabbers()
+                else:
+                    synced = self._read(cameras)
+                if synced is None:
+                    break
+                if not synced:
+                    if self.skew_stats.consecutive < self.max_rejected:
+                        continue
+                    logging.warning(
+                        "{} frame sets in a row exceeded the sync tolerance "
+                        "(last skew {:.1f} ms)."
+                        .format(self.skew_stats.consecutive,
+                                self.skew_stats.last * 1000))
+                    self.skew_stats.consecutive = 0
+                with self.metrics.measure("transform"):
+                    self.transform()
+                self.metrics.tick("capture")
+
+                with self.metrics.measure("update"):
+                    if update_fn(self) == False:
+                        running = False
 
         except KeyboardInterrupt:
             pass
 
-        for camera in cameras:
-            camera.release()
+        finally:
+            for grabber in self.grabbers:
+                grabber.stop()
+            if cameras is not self._captures:
+                for camera in cameras:
+                    self._release_capture(camera)
 
         cleanup_fn(self)
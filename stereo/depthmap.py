@@ -1,17 +1,41 @@
+from .calibration import write_atomic
+from .matchers import DEF_MATCHER, create_matcher
 import cv2 as cv
 from abc import ABC, abstractmethod
 import numpy as np
+import os
+import glob
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+_MAP_NAMES = ("left_map_x", "left_map_y", "right_map_x", "right_map_y")
+
+
+def split_rows(height, count, overlap=0):
+    """Split rows of an image into count horizontal strips. Return a list of
+    (start, end, inner_start, inner_end) tuples, where inner rows belong to the
+    strip and the others extend it by overlap rows on both sides.
+    """
+    bounds = np.linspace(0, height, count + 1).astype(int)
+    strips = []
+    for inner_start, inner_end in zip(bounds[:-1], bounds[1:]):
+        if inner_start == inner_end:
+            continue
+        strips.append((max(0, inner_start - overlap),
+                       min(height, inner_end + overlap),
+                       inner_start, inner_end))
+    return strips
 
 
 class StereoVision():
-    def __init__(self, calibration):
+    def __init__(self, calibration, matcher=DEF_MATCHER, matcher_params=None):
+        """Matcher is a name of a registered matcher backend (see
+        stereo.matchers), matcher_params override its default parameters.
+        """
         self.calibration = calibration
-        self.stereo = cv.StereoBM_create()
-        self.stereo.setMinDisparity(4)
-        self.stereo.setNumDisparities(128)
-        self.stereo.setBlockSize(21)
-        self.stereo.setSpeckleRange(16)
-        self.stereo.setSpeckleWindowSize(45)
+        if matcher_params is None:
+            matcher_params = {}
+        self.stereo = create_matcher(matcher, **matcher_params)
 
     @abstractmethod
     def calculate_depth(self):
@@ -19,44 +43,424 @@ class StereoVision():
 
 
 class StereoVision2Cams(StereoVision):
-    def __init__(self, calibration):
-        super().__init__(calibration)
-
-        self.left_max_x, self.left_map_y = cv.initUndistortRectifyMap(
-            self.calibration.left_matrix, self.calibration.left_dist_coeff,
-            self.calibration.left_rectif,
-            self.calibration.left_proj,
-            (self.calibration.width, self.calibration.height), cv.CV_32FC1
-        )
-
-        self.right_max_x, self.right_map_y = cv.initUndistortRectifyMap(
-            self.calibration.right_matrix, self.calibration.right_dist_coeff,
-            self.calibration.right_rectif,
-            self.calibration.right_proj,
-            (self.calibration.width, self.calibration.height), cv.CV_32FC1
-        )
-
-        self.depth = np.zeros((self.calibration.height, self.calibration.width),
-                              dtype=np.float32)
+    def __init__(self, calibration, fixed_point_maps=False,
+                 interpolation=cv.INTER_LINEAR, map_cache=True,
+                 depth_unit=1.0, matcher=DEF_MATCHER, matcher_params=None,
+                 scale=1.0, refine=False, refine_strips=8, refine_margin=4,
+                 roi=None, tiles=1, workers=None):
+        """If fixed_point_maps is True, the rectification maps are stored in
+        the compact CV_16SC2 + interpolation table representation, which is
+        faster to remap with. Interpolation can be cv.INTER_NEAREST for the
+        lowest latency (the interpolation table is not needed then).
+
+        Rectification maps are cached on disk in the map_cache directory or,
+        if map_cache is True, next to the loaded calibration file. Set it to
+        False to always compute them.
+
+        Metric depth is returned in calibration units (the units of the
+        pattern square size) multiplied by depth_unit, e.g. use 0.01 to get
+        meters from a calibration done in centimeters.
+
+        With scale < 1 disparity is computed on a downscaled rectified pair
+        with a proportionally smaller disparity range and upscaled to full
+        resolution. With refine=True it is then recomputed at full resolution
+        in refine_strips horizontal strips, each matched only within the
+        range of the coarse estimate in the strip (+- refine_margin pixels).
+
+        Roi (x, y, width, height) restricts rectification and matching to a
+        region of the rectified frame, all outputs then have the size of the
+        region. With tiles > 1 the rectified pair is split into horizontal
+        strips (overlapping by the reach of the block and the prefilter)
+        matched in parallel by a pool of workers threads. Block matching gives
+        the same results as without tiles, semi-global matching aggregates
+        costs along whole columns, so its results change at strip borders.
+        """
+        super().__init__(calibration, matcher, matcher_params)
+        self.fixed_point_maps = fixed_point_maps
+        self.interpolation = interpolation
+        self.map_cache = map_cache
+        self.depth_unit = depth_unit
+        self.scale = scale
+        self.refine = refine
+        self.refine_strips = refine_strips
+        self.refine_margin = refine_margin
+        if roi is None:
+            roi = (0, 0, self.calibration.width, self.calibration.height)
+        self.roi = tuple(roi)
+        self.output_size = (self.roi[2], self.roi[3])
+        self.coarse_size = (int(round(self.roi[2] * scale)),
+                            int(round(self.roi[3] * scale)))
+        self.tiles = tiles
+        self.workers = workers
+        self._executor = None
+        self._coarse_stereo = None
+        self._coarse_stereo_key = None
+        self._refine_stereo = None
+        self._refine_stereo_key = None
+        self._tile_stereos = {}
+
+        self.left_max_x, self.left_map_y, self.right_max_x, \
+            self.right_map_y = self._crop_maps(self._load_maps())
+
+        if self.fixed_point_maps:
+            self.left_max_x, self.left_map_y = self._to_fixed_point(
+                self.left_max_x, self.left_map_y)
+            self.right_max_x, self.right_map_y = self._to_fixed_point(
+                self.right_max_x, self.right_map_y)
+
         self.left = np.zeros((self.calibration.height, self.calibration.width),
                              dtype=np.uint8)
         self.right = np.zeros((self.calibration.height, self.calibration.width),
                               dtype=np.uint8)
+        # Output buffers reused by calculate_depth() for every frame
+        size = self.output_size[::-1]
+        rectified_size = self._map_roi()[3:1:-1]
+        self.left_rectified = np.zeros(rectified_size, dtype=np.uint8)
+        self.right_rectified = np.zeros(rectified_size, dtype=np.uint8)
+        self.disparity = np.zeros(size, dtype=np.int16)
+        self.depth = np.zeros(size, dtype=np.uint8)
+        self.metric_depth = np.zeros(size, dtype=np.float32)
+        self.xyz = np.zeros(size + (3,), dtype=np.float32)
+        self._disparity_float = np.zeros(size, dtype=np.float32)
+        self._depth_lut = None
+        self._depth_lut_key = None
+
+        # Q matrix for reprojection of pixels of the region
+        self._xyz_matrix = np.array(self.calibration.disparity_to_depth_matrix,
+                                    dtype=np.float64)
+        self._xyz_matrix[0, 3] += self.roi[0]
+        self._xyz_matrix[1, 3] += self.roi[1]
+
+        self.stereo.set_roi(*self._matcher_rois(1.0))
+
+    def _map_size(self):
+        """Return (width, height) of whole rectified frames. Frames are
+        rectified directly to the coarse size unless full resolution is needed.
+        """
+        if self.scale != 1.0 and not self.refine:
+            return (int(round(self.calibration.width * self.scale)),
+                    int(round(self.calibration.height * self.scale)))
+        return (self.calibration.width, self.calibration.height)
+
+    def _map_roi(self):
+        """Return the region of interest in the coordinates of the maps."""
+        scale = self._map_size()[0] / self.calibration.width
+        return self._scale_roi(self.roi, scale)
+
+    def _crop_maps(self, maps):
+        """Restrict the rectification maps to the region of interest."""
+        x, y, w, h = self._map_roi()
+        if (w, h) == self._map_size():
+            return maps
+        return tuple(np.ascontiguousarray(map[y:y + h, x:x + w])
+                     for map in maps)
+
+    def _matcher_rois(self, scale):
+        """Return valid regions of left and right rectified frames relative to
+        the region of interest and scaled.
+        """
+        rois = []
+        for roi in (self.calibration.left_roi, self.calibration.right_roi):
+            x = max(roi[0], self.roi[0])
+            y = max(roi[1], self.roi[1])
+            w = min(roi[0] + roi[2], self.roi[0] + self.roi[2]) - x
+            h = min(roi[1] + roi[3], self.roi[1] + self.roi[3]) - y
+            roi = (x - self.roi[0], y - self.roi[1], max(w, 0), max(h, 0))
+            rois.append(self._scale_roi(roi, scale))
+        return rois
+
+    @staticmethod
+    def _scale_roi(roi, scale):
+        return tuple(int(round(value * scale)) for value in roi)
+
+    def _compute_maps(self):
+        """Compute float rectification maps for both cameras."""
+        return self.calibration.rectification_maps(self._map_size())
+
+    def _map_cache_prefix(self):
+        """Return the path prefix of cached map files or None if caching is
+        not possible.
+        """
+        if self.map_cache is False or self.calibration.filename is None:
+            return None
+        name = os.path.basename(self.calibration.filename)
+        if self.map_cache is True:
+            directory = os.path.dirname(self.calibration.filename)
+        else:
+            directory = self.map_cache
+        return os.path.join(directory, name + ".maps")
+
+    def _load_maps(self):
+        """Load float rectification maps from the cache (memory-mapped) or
+        compute and cache them. Cached maps are keyed by the hash of the
+        calibration parameters and the target size, stale and unreadable ones
+        are removed.
+        """
+        prefix = self._map_cache_prefix()
+        size = self._map_size()
+        # Maps embedded in the calibration file need no caching
+        if prefix is None or size in self.calibration.maps:
+            return self._compute_maps()
+
+        key = self.calibration.get_hash(*size, "CV_32FC1")
+        prefix = "{}.{}x{}".format(prefix, *size)
+        filenames = ["{}.{}.{}.npy".format(prefix, key, name)
+                     for name in _MAP_NAMES]
+
+        if all(os.path.isfile(filename) for filename in filenames):
+            logging.info("Loading cached rectification maps {}.".format(
+                prefix))
+            try:
+                return tuple(np.load(filename, mmap_mode="r")
+                             for filename in filenames)
+            except (OSError, ValueError):
+                logging.warning("Cached rectification maps {} are unreadable,"
+                                " computing them again.".format(prefix),
+                                exc_info=True)
+
+        maps = self._compute_maps()
+        try:
+            for filename in glob.glob(glob.escape(prefix) + ".*.npy"):
+                os.remove(filename)
+            for filename, map in zip(filenames, maps):
+                write_atomic(filename,
+                             lambda file, map=map: np.save(file, map))
+            logging.info("Cached rectification maps in {}.".format(prefix))
+        except OSError:
+            logging.warning("Unable to cache rectification maps in {}."
+                            .format(prefix), exc_info=True)
+        return maps
+
+    def _to_fixed_point(self, map_x, map_y):
+        """Convert a pair of float maps to the fixed-point representation."""
+        map_xy, map_table = cv.convertMaps(map_x, map_y, cv.CV_16SC2)
+        if self.interpolation == cv.INTER_NEAREST:
+            map_table = None
+        return map_xy, map_table
 
-        self.stereo.setROI1(self.calibration.left_roi)
-        self.stereo.setROI2(self.calibration.right_roi)
+    def rectify(self, left, right, left_dst=None, right_dst=None):
+        """Return rectified versions of the given pair of frames, written into
+        left_dst and right_dst if they are given and match the frames.
+        """
+        left = cv.remap(left, self.left_max_x, self.left_map_y,
+                        self.interpolation, dst=left_dst
+                        )
+        right = cv.remap(right, self.right_max_x, self.right_map_y,
+                         self.interpolation, dst=right_dst
+                         )
+        return left, right
+
+    def compute_disparity(self, left, right, disparity=None):
+        """Compute the raw fixed-point (x16) disparity of a rectified pair at
+        full resolution.
+        """
+        if self.scale == 1.0:
+            return self._compute(self.stereo, left, right, disparity)
+
+        coarse_left, coarse_right = left, right
+        if self.refine:
+            coarse_left = cv.resize(left, self.coarse_size,
+                                    interpolation=cv.INTER_AREA)
+            coarse_right = cv.resize(right, self.coarse_size,
+                                     interpolation=cv.INTER_AREA)
+        coarse_stereo = self._get_coarse_stereo()
+        coarse = self._compute(coarse_stereo, coarse_left, coarse_right)
+        disparity = self._upscale_disparity(
+            coarse, coarse_stereo.get("MinDisparity"), disparity)
+
+        if self.refine:
+            disparity = self._refine_disparity(left, right, disparity)
+        return disparity
+
+    def _get_coarse_stereo(self):
+        """Return a matcher for coarse frames, following parameter changes of
+        the full resolution one.
+        """
+        key = self.stereo.get_params()
+        if self._coarse_stereo is None or self._coarse_stereo_key != key:
+            self._coarse_stereo = self.stereo.scaled(self.scale)
+            self._coarse_stereo.set_roi(*self._matcher_rois(self.scale))
+            self._coarse_stereo_key = key
+        return self._coarse_stereo
+
+    @staticmethod
+    def _set_strip_roi(stereo, rois, start, end):
+        """Set valid regions of a full frame shifted to a strip of its rows
+        start:end on the matcher of the strip.
+        """
+        if rois is None:
+            return
+        stereo.set_roi(*((x, y - start, w, h) for x, y, w, h in rois))
+
+    def _compute(self, stereo, left, right, disparity=None):
+        """Compute disparity with the given matcher, split into tiles matched
+        in parallel if requested.
+        """
+        if self.tiles <= 1:
+            return stereo.compute(left, right, disparity)
+
+        if disparity is None or disparity.shape != left.shape[:2]:
+            disparity = np.empty(left.shape[:2], dtype=np.int16)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers)
+
+        # Every tile needs its own matcher, OpenCV matchers are not reentrant.
+        # Speckles may cross strips, so they are filtered in the whole frame.
+        separate_speckles = stereo.speckle_range_scale is not None
+        params = stereo.get_params()
+        tile_stereos = self._tile_stereos.get(id(stereo))
+        if tile_stereos is None or tile_stereos[0] != params:
+            tile_stereos = (params, [stereo.clone()
+                                     for _ in range(self.tiles)])
+            if separate_speckles:
+                for tile_stereo in tile_stereos[1]:
+                    tile_stereo.set("SpeckleWindowSize", 0)
+            self._tile_stereos[id(stereo)] = tile_stereos
+
+        def compute_tile(tile):
+            (start, end, inner_start, inner_end), tile_stereo = tile
+            self._set_strip_roi(tile_stereo, stereo.rois, start, end)
+            strip = tile_stereo.compute(left[start:end], right[start:end])
+            disparity[inner_start:inner_end] = \
+                strip[inner_start - start:inner_end - start]
+
+        strips = split_rows(left.shape[0], self.tiles, stereo.border())
+        list(self._executor.map(compute_tile, zip(strips, tile_stereos[1])))
+        if separate_speckles:
+            stereo.filter_speckles(disparity)
+        return disparity
+
+    def _invalid_disparity(self, min_disparity):
+        return (min_disparity - 1) * 16
+
+    def _upscale_disparity(self, coarse, coarse_min_disparity, dst=None):
+        """Resize coarse disparity to full resolution and rescale its values
+        to full resolution pixels.
+        """
+        invalid = coarse < coarse_min_disparity * 16
+        coarse = cv.multiply(coarse, 1 / self.scale)
+        coarse[invalid] = self._invalid_disparity(
+            self.stereo.get("MinDisparity"))
+        return cv.resize(coarse, self.output_size, dst,
+                         interpolation=cv.INTER_NEAREST)
+
+    def _refine_disparity(self, left, right, disparity):
+        """Recompute disparity at full resolution strip by strip, searching
+        only the disparity range of the coarse estimate in each strip.
+        """
+        # The strip loop changes the disparity range of the clone, so it is
+        # compared by the parameters it was cloned with
+        key = self.stereo.get_params()
+        if self._refine_stereo is None or self._refine_stereo_key != key:
+            self._refine_stereo = self.stereo.clone()
+            self._refine_stereo_key = key
+        min_disparity = self.stereo.get("MinDisparity")
+        invalid = self._invalid_disparity(min_disparity)
+        overlap = self.stereo.border()
+
+        for start, end, inner_start, inner_end in split_rows(
+                left.shape[0], self.refine_strips, overlap):
+            coarse = disparity[inner_start:inner_end]
+            valid = coarse[coarse > invalid]
+            if valid.size == 0:
+                continue
+            low, high = np.percentile(valid, (5, 95)) / 16
+            strip_min = max(min_disparity,
+                            int(np.floor(low)) - self.refine_margin)
+            strip_num = int(np.ceil(
+                (high - strip_min + self.refine_margin + 1) / 16)) * 16
+            self._refine_stereo.set("MinDisparity", strip_min)
+            self._refine_stereo.set("NumDisparities", max(16, strip_num))
+
+            strip = self._refine_stereo.compute(left[start:end],
+                                                right[start:end])
+            strip = strip[inner_start - start:inner_end - start]
+            strip[strip < strip_min * 16] = invalid
+            disparity[inner_start:inner_end] = strip
+        return disparity
+
+    def match(self, left, right, disparity=None, dst=None):
+        """Compute the disparity of a rectified pair of frames and return it
+        scaled to uint8. The raw disparity is written into disparity and the
+        result into dst if they are given.
+        """
+        disparity = self.compute_disparity(left, right, disparity)
+        return cv.convertScaleAbs(disparity, dst, 255 / 2096)
+
+    def _get_depth_lut(self):
+        """Return a lookup table mapping every raw int16 disparity (viewed as
+        uint16) to the distance along the optical axis. Invalid and
+        non-positive disparities map to 0.
+        """
+        q = np.asarray(self.calibration.disparity_to_depth_matrix)
+        key = (self.stereo.get("MinDisparity"), self.depth_unit, q.tobytes())
+        if self._depth_lut is not None and self._depth_lut_key == key:
+            return self._depth_lut
+
+        raw = np.arange(2 ** 16, dtype=np.uint16).view(np.int16)
+        disparity = raw.astype(np.float64) / 16
+        with np.errstate(divide="ignore", invalid="ignore"):
+            depth = np.abs(q[2, 3] / (q[3, 2] * disparity + q[3, 3])
+                           * self.depth_unit)
+        invalid = (raw < self.stereo.get("MinDisparity") * 16) \
+            | (disparity <= 0) | ~np.isfinite(depth)
+        depth[invalid] = 0
+
+        self._depth_lut = depth.astype(np.float32)
+        self._depth_lut_key = key
+        return self._depth_lut
+
+    def disparity_to_depth(self, disparity, dst=None):
+        """Convert raw disparity to float32 metric depth with a single lookup
+        table gather.
+        """
+        return np.take(self._get_depth_lut(), disparity.view(np.uint16),
+                       out=dst)
+
+    def disparity_to_xyz(self, disparity, dst=None):
+        """Reproject raw disparity to a float32 XYZ image in calibration units
+        multiplied by depth_unit.
+        """
+        if disparity is self.disparity:
+            disparity_float = self._disparity_float
+        else:
+            disparity_float = None
+        disparity_float = np.multiply(disparity, 1 / 16, out=disparity_float,
+                                      dtype=np.float32, casting="unsafe")
+        xyz = cv.reprojectImageTo3D(disparity_float, self._xyz_matrix, dst,
+                                    True)
+        if self.depth_unit != 1.0:
+            xyz *= self.depth_unit
+        return xyz
 
     def preprocess_frames(self):
-        self.left = cv.remap(self.left, self.left_max_x, self.left_map_y,
-                             cv.INTER_LINEAR
-                             )
-        self.right = cv.remap(self.right, self.right_max_x, self.right_map_y,
-                              cv.INTER_LINEAR
-                              )
+        """Rectify left and right frames into left_rectified and
+        right_rectified buffers.
+        """
+        self.left_rectified, self.right_rectified = self.rectify(
+            self.left, self.right, self.left_rectified, self.right_rectified)
+        return self.left_rectified, self.right_rectified
 
-    def calculate_depth(self):
-        self.preprocess_frames()
-        self.depth = (self.stereo.compute(
-            self.left, self.right) / 2096 * 255).astype(np.uint8)
-        # self.depth = (self.stereo.compute(self.left, self.right)) #.astype(np.uint8)
-        return self.depth
+    def calculate_depth(self, output="visual", rectify=True):
+        """Calculate depth of the current left and right frames. Output can be
+        "visual" (uint8 disparity for display), "metric" (float32 depth) or
+        "xyz" (float32 3D points). With rectify=False the frames are expected
+        to be already rectified by preprocess_frames().
+        """
+        if rectify:
+            self.preprocess_frames()
+        if output == "visual":
+            self.depth = self.match(self.left_rectified, self.right_rectified,
+                                    self.disparity, self.depth)
+            return self.depth
+
+        self.disparity = self.compute_disparity(
+            self.left_rectified, self.right_rectified, self.disparity)
+        if output == "metric":
+            self.metric_depth = self.disparity_to_depth(self.disparity,
+                                                        self.metric_depth)
+            return self.metric_depth
+        elif output == "xyz":
+            self.xyz = self.disparity_to_xyz(self.disparity, self.xyz)
+            return self.xyz
+        raise ValueError("Unknown depth output: {}".format(output))
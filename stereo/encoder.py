@@ -0,0 +1,116 @@
+from .metrics import Metrics
+import cv2 as cv
+import logging
+import threading
+import time
+
+DEF_JPEG_QUALITY = 80
+DEF_MAX_DISPLAY_FPS = 15
+
+
+class WidgetEncoder(threading.Thread):
+    """Encode frames to JPEG and send them to ipywidgets.Image widgets in
+    a background thread, so that the capture loop never waits for encoding or
+    for the frontend. Only the newest submitted frame of each widget is kept,
+    widgets are updated at most max_fps times per second and frames can be
+    downscaled by scale before encoding. Submitted frames must not be modified
+    afterwards.
+    """
+
+    def __init__(self, quality=DEF_JPEG_QUALITY, scale=1.0,
+                 max_fps=DEF_MAX_DISPLAY_FPS, metrics=None):
+        super().__init__(daemon=True)
+        self.quality = quality
+        self.scale = scale
+        self.max_fps = max_fps
+        if metrics is None:
+            metrics = Metrics(enabled=False)
+        self.metrics = metrics
+
+        self.submitted = 0
+        self.sent = 0
+        self.skipped = 0  # frames replaced by newer ones before encoding
+
+        self._pending = {}
+        self._buffers = {}
+        self._condition = threading.Condition()
+        self._running = True
+        self._last_time = 0.0
+
+    def submit(self, widget, frame, rgb=False):
+        """Queue a frame (BGR, or RGB if rgb is True, or grayscale) to be
+        displayed by the widget, replacing a frame still waiting for it.
+        """
+        with self._condition:
+            self.submitted += 1
+            if id(widget) in self._pending:
+                self.skipped += 1
+            self._pending[id(widget)] = (widget, frame, rgb)
+            self._condition.notify()
+
+    def encode(self, key, frame, rgb=False):
+        """Return JPEG bytes of a frame. Intermediate images are kept in
+        buffers of the given key between calls.
+        """
+        resized, converted = self._buffers.get(key, (None, None))
+        if self.scale != 1.0:
+            resized = cv.resize(frame, None, resized, self.scale, self.scale,
+                                cv.INTER_AREA)
+            frame = resized
+        if rgb and frame.ndim == 3:
+            converted = cv.cvtColor(frame, cv.COLOR_RGB2BGR, converted)
+            frame = converted
+        self._buffers[key] = (resized, converted)
+
+        ret, data = cv.imencode(".jpg", frame,
+                                (cv.IMWRITE_JPEG_QUALITY, self.quality))
+        if not ret:
+            raise ValueError("Unable to encode a frame.")
+        return data.tobytes()
+
+    def run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._pending or not self._running)
+                if not self._running:
+                    break
+
+            # Let more frames coalesce until the next update is due
+            if self.max_fps:
+                delay = self._last_time + 1 / self.max_fps - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            with self._condition:
+                pending = list(self._pending.items())
+                self._pending.clear()
+            self._last_time = time.monotonic()
+
+            for key, (widget, frame, rgb) in pending:
+                try:
+                    with self.metrics.measure("encode"):
+                        value = self.encode(key, frame, rgb)
+                    with self.metrics.measure("display"):
+                        widget.value = value
+                    self.sent += 1
+                except Exception:
+                    logging.error("Unable to display a frame:", exc_info=True)
+            self.metrics.tick("display")
+
+    def stats(self):
+        """Return frame counters as a dict."""
+        with self._condition:
+            return {
+                "submitted": self.submitted,
+                "sent": self.sent,
+                "skipped": self.skipped,
+            }
+
+    def stop(self):
+        """Stop the worker (pending frames are dropped) and wait for it."""
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
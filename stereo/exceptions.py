@@ -20,4 +20,12 @@ class CameraError(Exception):
     """Ambiguous camera error class."""
 
 class CameraCaptureError(CameraError):
-    """Unable to capture image from camera."""
\ No newline at end of file
+    """Unable to capture image from camera."""
+
+class StereoVisionError(Exception):
+    """Ambiguous stereo vision error class."""
+
+class MatcherNotAvailable(StereoVisionError):
+    """The requested stereo matcher is unknown or its dependencies are not
+       installed.
+    """
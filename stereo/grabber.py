@@ -0,0 +1,164 @@
+from .exceptions import CameraCaptureError
+from .metrics import Metrics
+import cv2 as cv
+import collections
+import threading
+import time
+
+DEF_BUFFER_SIZE = 4
+
+Frame = collections.namedtuple("Frame", ["seq", "timestamp", "pos_msec",
+                                         "image"])
+Frame.__doc__ = """A captured frame tagged with its sequence number, monotonic
+host time of the grab (seconds) and CAP_PROP_POS_MSEC reported by the backend
+(<= 0 if not provided or not comparable between cameras).
+"""
+
+Timestamp = collections.namedtuple("Timestamp", ["timestamp", "pos_msec"])
+
+# Backends whose CAP_PROP_POS_MSEC is comparable between devices: V4L2 reports
+# kernel buffer timestamps and replayed recordings share their timeline. Others
+# report e.g. the position in their own pipeline (GStreamer), which is offset
+# by the start time of every pipeline.
+SHARED_CLOCK_BACKENDS = {"V4L2", "REPLAY"}
+
+
+def has_shared_clock(camera):
+    """Return True if backend timestamps of the camera can be compared with
+    the ones of other cameras.
+    """
+    try:
+        return camera.getBackendName() in SHARED_CLOCK_BACKENDS
+    except (AttributeError, cv.error):
+        return False
+
+
+def grab_timestamp(camera, shared_clock=None):
+    """Return the Timestamp of a frame that has just been grabbed. The backend
+    time is left out (0) unless the camera has a shared clock.
+    """
+    if shared_clock is None:
+        shared_clock = has_shared_clock(camera)
+    pos_msec = camera.get(cv.CAP_PROP_POS_MSEC) if shared_clock else 0
+    return Timestamp(time.monotonic(), pos_msec)
+
+
+class FrameGrabber(threading.Thread):
+    """Continuously grab frames from a single camera in a background thread and
+    keep the most recent ones in a small ring buffer, so that the driver queue
+    never fills up with stale frames while the consumer is busy.
+    """
+
+    def __init__(self, camera, buffer_size=DEF_BUFFER_SIZE, metrics=None):
+        super().__init__(daemon=True)
+        self.camera = camera
+        if metrics is None:
+            metrics = Metrics(enabled=False)
+        self.metrics = metrics
+        self.buffer = collections.deque(maxlen=buffer_size)
+        self.error = None
+
+        self.grabbed = 0  # frames read from the driver
+        self.consumed = 0  # frames handed to the consumer
+        self.dropped = 0  # frames never handed to the consumer
+        self.overwritten = 0  # unconsumed frames pushed out of the buffer
+
+        self._seq = -1
+        self._consumed_seq = -1
+        self._condition = threading.Condition()
+        self._running = True
+
+    def run(self):
+        shared_clock = has_shared_clock(self.camera)
+        while self._running:
+            with self.metrics.measure("grab"):
+                ret = self.camera.grab()
+            if not ret:
+                self._fail("Unable to grab image from cam")
+                break
+            timestamp, pos_msec = grab_timestamp(self.camera, shared_clock)
+            with self.metrics.measure("retrieve"):
+                ret, image = self.camera.retrieve()
+            if not ret:
+                self._fail("Unable to retrieve image from cam")
+                break
+
+            with self._condition:
+                if len(self.buffer) == self.buffer.maxlen \
+                        and self.buffer[0].seq > self._consumed_seq:
+                    self.overwritten += 1
+                self._seq += 1
+                self.grabbed += 1
+                self.buffer.append(
+                    Frame(self._seq, timestamp, pos_msec, image))
+                self._condition.notify_all()
+
+    def _fail(self, message):
+        with self._condition:
+            self.error = CameraCaptureError(message, self.camera)
+            self._running = False
+            self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        """Wait for a frame newer than the last consumed one and return it
+        without consuming it, or None on timeout. Frames grabbed before
+        a failure are returned first, its error is raised once none is left.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._seq > self._consumed_seq
+                or self.error is not None or not self._running,
+                timeout
+            )
+            if self._seq > self._consumed_seq:
+                return self.buffer[-1]
+            if self.error is not None:
+                raise self.error
+            return None
+
+    def _consume(self, frame):
+        self.dropped += frame.seq - self._consumed_seq - 1
+        self.consumed += 1
+        self._consumed_seq = frame.seq
+        return frame
+
+    def latest(self, timeout=None):
+        """Wait for a frame newer than the last consumed one and return the
+        freshest Frame or None on timeout. Frames skipped on the way are
+        counted as dropped.
+        """
+        if self.wait(timeout) is None:
+            return None
+        with self._condition:
+            return self._consume(self.buffer[-1])
+
+    def nearest(self, time_fn, reference):
+        """Consume and return the not yet consumed buffered Frame whose time
+        (as returned by time_fn) is the closest to reference.
+        """
+        with self._condition:
+            candidates = [frame for frame in self.buffer
+                          if frame.seq > self._consumed_seq]
+            if not candidates:
+                return None
+            frame = min(candidates,
+                        key=lambda frame: abs(time_fn(frame) - reference))
+            return self._consume(frame)
+
+    def stats(self):
+        """Return frame counters as a dict."""
+        with self._condition:
+            return {
+                "grabbed": self.grabbed,
+                "consumed": self.consumed,
+                "dropped": self.dropped,
+                "overwritten": self.overwritten,
+            }
+
+    def stop(self):
+        """Stop the grabbing loop and wait for the thread to finish."""
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,250 @@
+from .exceptions import MatcherNotAvailable
+import cv2 as cv
+from abc import ABC, abstractmethod
+
+MATCHERS = {}
+DEF_MATCHER = "bm"
+
+
+def register_matcher(name):
+    """Class decorator which makes a Matcher available under the given name."""
+    def decorator(cls):
+        cls.name = name
+        MATCHERS[name] = cls
+        return cls
+    return decorator
+
+
+def create_matcher(name=DEF_MATCHER, **params):
+    """Create a registered matcher and set its parameters."""
+    if name not in MATCHERS:
+        raise MatcherNotAvailable("Unknown matcher: {}. Available: {}."
+                                  .format(name, ", ".join(MATCHERS)))
+    return MATCHERS[name](**params)
+
+
+class Matcher(ABC):
+    """Common interface of stereo matchers. Tunables describe parameters which
+    can be changed at runtime as a dict {name: spec}, where the spec is
+    ("int", min, max, step), ("float", min, max, step) or ("choice", options)
+    and the name is the suffix of the get/set methods of the OpenCV matcher.
+    Unknown attributes are looked up in the underlying OpenCV matcher.
+    """
+    tunables = {}
+    defaults = {}
+    min_block_size = 1
+    rois = None
+    # SpeckleRange units per raw disparity unit, None if speckles are not
+    # filtered as a separate last step of compute()
+    speckle_range_scale = None
+
+    def __init__(self, **params):
+        self.matcher = self._create()
+        for name, value in dict(self.defaults, **params).items():
+            self.set(name, value)
+
+    @abstractmethod
+    def _create(self):
+        pass
+
+    def __getattr__(self, name):
+        if name == "matcher":
+            raise AttributeError(name)
+        return getattr(self.matcher, name)
+
+    def get(self, name):
+        return getattr(self.matcher, "get" + name)()
+
+    def set(self, name, value):
+        getattr(self.matcher, "set" + name)(value)
+
+    def get_params(self):
+        """Return a dict with current values of all tunables."""
+        return {name: self.get(name) for name in self.tunables}
+
+    def set_roi(self, left_roi, right_roi):
+        """Restrict matching to valid regions of rectified images if the
+        backend supports it. The regions are kept in rois.
+        """
+        self.rois = (tuple(left_roi), tuple(right_roi))
+
+    def border(self):
+        """Return how many pixels around a pixel affect its disparity."""
+        border = self.get("BlockSize") // 2
+        if "PreFilterSize" in self.tunables:
+            border += self.get("PreFilterSize") // 2
+        return border
+
+    def compute(self, left, right, disparity=None):
+        """Return the fixed-point (x16) int16 disparity of a rectified pair."""
+        return self.matcher.compute(left, right, disparity)
+
+    def filter_speckles(self, disparity):
+        """Invalidate small regions of similar disparity in place the same way
+        as compute() does (see speckle_range_scale).
+        """
+        size = self.get("SpeckleWindowSize")
+        speckle_range = self.get("SpeckleRange")
+        if size > 0 and speckle_range >= 0:
+            cv.filterSpeckles(disparity, (self.get("MinDisparity") - 1) * 16,
+                              size, speckle_range * self.speckle_range_scale)
+        return disparity
+
+    def clone(self):
+        """Return a new matcher of the same type and with the same parameters."""
+        return type(self)(**self.get_params())
+
+    def scaled(self, scale):
+        """Return a clone with disparity range and block size adjusted for
+        images scaled by the given factor.
+        """
+        params = self.get_params()
+        params["MinDisparity"] = int(round(params["MinDisparity"] * scale))
+        params["NumDisparities"] = max(16, int(round(
+            params["NumDisparities"] * scale / 16)) * 16)
+        block_size = int(round(params["BlockSize"] * scale)) | 1
+        params["BlockSize"] = max(self.min_block_size, block_size)
+        return type(self)(**params)
+
+
+@register_matcher("bm")
+class BMMatcher(Matcher):
+    """Block matching (cv.StereoBM), the fastest backend."""
+    tunables = {
+        "BlockSize": ("int", 5, 99, 2),
+        "MinDisparity": ("int", -8, 256, 1),
+        "NumDisparities": ("int", 16, 256, 16),
+        "SpeckleRange": ("int", -8, 256, 1),
+        "SpeckleWindowSize": ("int", -8, 512, 1),
+        "TextureThreshold": ("int", 0, 512, 1),
+        "PreFilterCap": ("int", 1, 63, 1),
+        "PreFilterSize": ("int", 5, 255, 2),
+        "PreFilterType": ("choice", (("PREFILTER_NORMALIZED_RESPONSE", 0),
+                                     ("PREFILTER_XSOBEL", 1))),
+        "SmallerBlockSize": ("int", -1005, 255, 2),
+        "UniquenessRatio": ("int", 0, 128, 2),
+    }
+    defaults = {
+        "MinDisparity": 4,
+        "NumDisparities": 128,
+        "BlockSize": 21,
+        "SpeckleRange": 16,
+        "SpeckleWindowSize": 45,
+    }
+    min_block_size = 5
+    speckle_range_scale = 1
+
+    def _create(self):
+        return cv.StereoBM_create()
+
+    def set_roi(self, left_roi, right_roi):
+        super().set_roi(left_roi, right_roi)
+        self.matcher.setROI1(tuple(left_roi))
+        self.matcher.setROI2(tuple(right_roi))
+
+
+@register_matcher("sgbm")
+class SGBMMatcher(Matcher):
+    """Semi-global block matching (cv.StereoSGBM), slower but denser than
+    block matching. Mode selects the speed/quality trade-off, MODE_SGBM_3WAY
+    and MODE_HH4 are the fast ones.
+    """
+    tunables = {
+        "BlockSize": ("int", 1, 31, 2),
+        "MinDisparity": ("int", -8, 256, 1),
+        "NumDisparities": ("int", 16, 256, 16),
+        "P1": ("int", 0, 4096, 8),
+        "P2": ("int", 0, 16384, 32),
+        "Disp12MaxDiff": ("int", -1, 256, 1),
+        "PreFilterCap": ("int", 1, 63, 1),
+        "UniquenessRatio": ("int", 0, 128, 1),
+        "SpeckleRange": ("int", 0, 256, 1),
+        "SpeckleWindowSize": ("int", 0, 512, 1),
+        "Mode": ("choice", (("MODE_SGBM", cv.STEREO_SGBM_MODE_SGBM),
+                            ("MODE_HH", cv.STEREO_SGBM_MODE_HH),
+                            ("MODE_SGBM_3WAY", cv.STEREO_SGBM_MODE_SGBM_3WAY),
+                            ("MODE_HH4", cv.STEREO_SGBM_MODE_HH4))),
+    }
+    defaults = {
+        "MinDisparity": 4,
+        "NumDisparities": 128,
+        "BlockSize": 5,
+        "P1": 8 * 5 * 5,
+        "P2": 32 * 5 * 5,
+        "Disp12MaxDiff": 1,
+        "PreFilterCap": 63,
+        "UniquenessRatio": 10,
+        "SpeckleRange": 16,
+        "SpeckleWindowSize": 45,
+        "Mode": cv.STEREO_SGBM_MODE_SGBM_3WAY,
+    }
+    speckle_range_scale = 16
+
+    def _create(self):
+        return cv.StereoSGBM_create()
+
+
+class WLSMatcher(Matcher):
+    """Left-right consistency check with weighted least squares disparity
+    filtering on top of another backend (requires opencv-contrib).
+    """
+    base = None
+    wls_tunables = {
+        "Lambda": ("float", 0, 20000, 100),
+        "SigmaColor": ("float", 0.1, 5, 0.1),
+    }
+    wls_defaults = {
+        "Lambda": 8000.0,
+        "SigmaColor": 1.5,
+    }
+
+    def __init__(self, **params):
+        if not hasattr(cv, "ximgproc"):
+            raise MatcherNotAvailable(
+                "The {} matcher requires opencv-contrib-python.".format(
+                    self.name))
+        self.wls = None
+        self.right_matcher = None
+        super().__init__(**dict(self.wls_defaults, **params))
+
+    def _create(self):
+        matcher = self.base._create(self)
+        self.wls = cv.ximgproc.createDisparityWLSFilter(matcher)
+        self.right_matcher = cv.ximgproc.createRightMatcher(matcher)
+        return matcher
+
+    def get(self, name):
+        if name in self.wls_tunables:
+            return getattr(self.wls, "get" + name)()
+        return super().get(name)
+
+    def set(self, name, value):
+        if name in self.wls_tunables:
+            getattr(self.wls, "set" + name)(value)
+            return
+        super().set(name, value)
+        # The right matcher copies parameters of the left one on creation
+        self.right_matcher = cv.ximgproc.createRightMatcher(self.matcher)
+
+    def compute(self, left, right, disparity=None):
+        left_disparity = self.matcher.compute(left, right)
+        right_disparity = self.right_matcher.compute(right, left)
+        return self.wls.filter(left_disparity, left, disparity,
+                               right_disparity)
+
+
+@register_matcher("bm-wls")
+class BMWLSMatcher(WLSMatcher):
+    """Block matching with WLS filtering."""
+    base = BMMatcher
+    min_block_size = BMMatcher.min_block_size
+    tunables = dict(BMMatcher.tunables, **WLSMatcher.wls_tunables)
+    defaults = BMMatcher.defaults
+
+
+@register_matcher("sgbm-wls")
+class SGBMWLSMatcher(WLSMatcher):
+    """Semi-global block matching with WLS filtering."""
+    base = SGBMMatcher
+    tunables = dict(SGBMMatcher.tunables, **WLSMatcher.wls_tunables)
+    defaults = SGBMMatcher.defaults
@@ -0,0 +1,189 @@
+import bisect
+import collections
+import contextlib
+import csv
+import json
+import math
+import os
+import threading
+import time
+
+DEF_FPS_WINDOW = 60
+DEF_DUMP_INTERVAL = 10.0
+
+# Log-spaced bucket edges in seconds, 8 per decade from 1 us to 10 s
+_EDGES = [10 ** (exp / 8) for exp in range(-48, 9)]
+_NULL_TIMER = contextlib.nullcontext()
+
+
+class Histogram:
+    """Fixed-size histogram of durations (in seconds) with log-spaced
+    buckets. Percentiles are estimated by upper bucket edges, i.e. within
+    about 33% of the exact value.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(_EDGES) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def record(self, duration):
+        self.counts[bisect.bisect_left(_EDGES, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.min = min(self.min, duration)
+        self.max = max(self.max, duration)
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        cumulative = 0
+        for idx, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                if idx == len(_EDGES):
+                    return self.max
+                return min(_EDGES[idx], self.max)
+        return self.max
+
+    def snapshot(self):
+        """Return count and mean, min, max, p50, p95 and p99 durations in
+        milliseconds as a dict.
+        """
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.total / self.count * 1000,
+            "min": self.min * 1000,
+            "max": self.max * 1000,
+            "p50": self.percentile(50) * 1000,
+            "p95": self.percentile(95) * 1000,
+            "p99": self.percentile(99) * 1000,
+        }
+
+
+class _Timer:
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.record(self.stage, time.perf_counter() - self.start)
+
+
+class Metrics:
+    """Per-stage timing of capture and streams. Durations are collected in
+    histograms with measure() or record(), frame rates over the last `window`
+    frames with tick(). If dump_path (.csv or .json) is given, a snapshot is
+    written there every dump_interval seconds. A disabled instance does
+    nothing, so it can be always called.
+    """
+
+    def __init__(self, enabled=True, window=DEF_FPS_WINDOW, dump_path=None,
+                 dump_interval=DEF_DUMP_INTERVAL):
+        self.enabled = enabled
+        self.window = window
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.ticks = {}
+            self._last_dump = time.monotonic()
+
+    def measure(self, stage):
+        """Return a context manager which records its duration under the
+        stage name.
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def record(self, stage, duration):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.record(duration)
+
+    def tick(self, counter="frames"):
+        """Count a frame for the rolling frame rate of the given counter."""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            ticks = self.ticks.get(counter)
+            if ticks is None:
+                ticks = self.ticks[counter] = collections.deque(
+                    maxlen=self.window)
+            ticks.append(now)
+            dump = (self.dump_path is not None
+                    and now - self._last_dump >= self.dump_interval)
+            if dump:
+                self._last_dump = now
+        if dump:
+            self.dump()
+
+    def _fps(self, ticks):
+        if len(ticks) < 2 or ticks[-1] == ticks[0]:
+            return None
+        return (len(ticks) - 1) / (ticks[-1] - ticks[0])
+
+    def fps(self, counter="frames"):
+        """Return the frame rate over the last window frames or None."""
+        with self._lock:
+            return self._fps(self.ticks.get(counter, ()))
+
+    def snapshot(self):
+        """Return a dict with frame rates of all counters and statistics of
+        all stages (see Histogram.snapshot()).
+        """
+        with self._lock:
+            return {
+                "time": time.time(),
+                "fps": {counter: self._fps(ticks)
+                        for counter, ticks in self.ticks.items()},
+                "stages": {stage: histogram.snapshot()
+                           for stage, histogram in self.histograms.items()},
+            }
+
+    def dump(self, path=None):
+        """Write a snapshot to a JSON file (replaced) or a CSV file (one row
+        per stage appended) chosen by the extension of path or dump_path.
+        """
+        path = self.dump_path if path is None else path
+        snapshot = self.snapshot()
+        if os.path.splitext(path)[1].lower() != ".csv":
+            with open(path, "w") as file:
+                json.dump(snapshot, file, indent=2)
+            return snapshot
+
+        fields = ["time", "stage", "count", "mean", "min", "max", "p50",
+                  "p95", "p99"]
+        write_header = not os.path.isfile(path)
+        with open(path, "a", newline="") as file:
+            writer = csv.DictWriter(file, fields, restval="")
+            if write_header:
+                writer.writeheader()
+            for stage, stats in snapshot["stages"].items():
+                writer.writerow(dict(stats, time=snapshot["time"],
+                                     stage=stage))
+            for counter, fps in snapshot["fps"].items():
+                writer.writerow({"time": snapshot["time"],
+                                 "stage": counter + "_fps", "mean": fps})
+        return snapshot
@@ -0,0 +1,110 @@
+import collections
+import logging
+import threading
+
+DEF_QUEUE_SIZE = 1
+
+
+class DropQueue:
+    """Bounded queue which drops the oldest item instead of blocking the
+    producer when it is full.
+    """
+
+    def __init__(self, maxsize=DEF_QUEUE_SIZE):
+        self.items = collections.deque(maxlen=maxsize)
+        self.dropped = 0
+        self.closed = False
+        self._condition = threading.Condition()
+
+    def put(self, item):
+        with self._condition:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+            self.items.append(item)
+            self._condition.notify()
+
+    def get(self):
+        """Wait for an item and return it or return None if the queue has been
+        closed.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.items or self.closed)
+            if self.closed:
+                return None
+            return self.items.popleft()
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class Stage(threading.Thread):
+    """Pipeline worker which takes items from the input queue, passes them to
+    fn and puts the results into the output queue. If fn returns None, the item
+    is not passed further.
+    """
+
+    def __init__(self, pipeline, name, fn, input, output=None):
+        super().__init__(name=name, daemon=True)
+        self.pipeline = pipeline
+        self.fn = fn
+        self.input = input
+        self.output = output
+
+    def run(self):
+        while True:
+            item = self.input.get()
+            if item is None:
+                break
+            try:
+                item = self.fn(item)
+            except Exception:
+                logging.error("Fatal exception in the {} pipeline stage:"
+                              .format(self.name), exc_info=True)
+                self.pipeline.stop()
+                break
+            if item is not None and self.output is not None:
+                self.output.put(item)
+
+
+class Pipeline:
+    """Chain of stages, each running in its own thread, connected by bounded
+    drop-oldest queues. Stages should be a list of (name, function) tuples.
+    """
+
+    def __init__(self, stages, queue_size=DEF_QUEUE_SIZE):
+        self.queues = [DropQueue(queue_size) for _ in stages]
+        self.stages = []
+        for idx, (name, fn) in enumerate(stages):
+            output = None
+            if idx + 1 < len(stages):
+                output = self.queues[idx + 1]
+            self.stages.append(Stage(self, name, fn, self.queues[idx], output))
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    def put(self, item):
+        """Feed an item to the first stage."""
+        self.queues[0].put(item)
+
+    def stop(self):
+        """Close all queues, which makes all stages finish."""
+        self.running = False
+        for queue in self.queues:
+            queue.close()
+
+    def join(self):
+        for stage in self.stages:
+            if stage.is_alive() and stage is not threading.current_thread():
+                stage.join()
+
+    def get_dropped(self):
+        """Return a dict with numbers of items dropped before each stage."""
+        return {stage.name: queue.dropped
+                for stage, queue in zip(self.stages, self.queues)}
@@ -0,0 +1,230 @@
+import cv2 as cv
+import collections
+import glob
+import json
+import logging
+import os
+import re
+import struct
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DEF_PROBE_TIMEOUT = 2.0
+DEF_PROBE_RANGE = 32
+DEF_PROBE_CACHE = os.path.join(os.path.expanduser("~"), ".cache",
+                               "stereo-cameras.json")
+
+Format = collections.namedtuple("Format", ["fourcc", "width", "height",
+                                           "fps"])
+CameraInfo = collections.namedtuple("CameraInfo", ["index", "path", "name",
+                                                   "formats"])
+CameraInfo.__doc__ = """A capture device with the list of supported Formats
+(fourcc, width, height and a list of frame rates).
+"""
+
+# V4L2 ioctls, see linux/videodev2.h
+_VIDIOC_QUERYCAP = 0x80685600
+_VIDIOC_ENUM_FMT = 0xc0405602
+_VIDIOC_ENUM_FRAMESIZES = 0xc02c564a
+_VIDIOC_ENUM_FRAMEINTERVALS = 0xc034564b
+_V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+_V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+_V4L2_CAP_DEVICE_CAPS = 0x80000000
+_V4L2_FRMSIZE_TYPE_DISCRETE = 1
+_V4L2_FRMIVAL_TYPE_DISCRETE = 1
+
+_cache = {}
+
+
+def _ioctl_enum(fd, request, fmt, *fields):
+    """Yield unpacked results of an enumerating ioctl for index 0, 1, ...
+    until the driver reports the end (EINVAL).
+    """
+    index = 0
+    while True:
+        buffer = bytearray(struct.pack(fmt, index, *fields))
+        try:
+            fcntl.ioctl(fd, request, buffer)
+        except OSError:
+            return
+        yield struct.unpack(fmt, buffer)
+        index += 1
+
+
+def _fourcc_str(code):
+    return "".join(chr((code >> 8 * i) & 0xff) for i in range(4))
+
+
+def _probe_v4l2(path):
+    """Query a V4L2 device node for its name and supported formats without
+    starting a capture. Return None if it is not a video capture device.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+    try:
+        buffer = bytearray(104)
+        fcntl.ioctl(fd, _VIDIOC_QUERYCAP, buffer)
+        _, card, _, _, capabilities, device_caps = struct.unpack(
+            "16s32s32sIII12x", buffer)
+        if capabilities & _V4L2_CAP_DEVICE_CAPS:
+            capabilities = device_caps
+        if not capabilities & _V4L2_CAP_VIDEO_CAPTURE:
+            return None
+        name = card.split(b"\0", 1)[0].decode(errors="replace")
+
+        formats = []
+        for fmt in _ioctl_enum(fd, _VIDIOC_ENUM_FMT, "III32sII12x",
+                               _V4L2_BUF_TYPE_VIDEO_CAPTURE, 0, b"", 0, 0):
+            pixel_format = fmt[4]
+            for size in _ioctl_enum(fd, _VIDIOC_ENUM_FRAMESIZES, "III6I8x",
+                                    pixel_format, 0, 0, 0, 0, 0, 0, 0):
+                if size[2] != _V4L2_FRMSIZE_TYPE_DISCRETE:
+                    # Stepwise sizes, report the largest one
+                    width, height = size[4], size[7]
+                else:
+                    width, height = size[3], size[4]
+                fps = []
+                for interval in _ioctl_enum(
+                        fd, _VIDIOC_ENUM_FRAMEINTERVALS, "IIIII6I8x",
+                        pixel_format, width, height, 0, 0, 0, 0, 0, 0, 0):
+                    if interval[4] == _V4L2_FRMIVAL_TYPE_DISCRETE \
+                            and interval[5]:
+                        fps.append(interval[6] / interval[5])
+                formats.append(Format(_fourcc_str(pixel_format), width,
+                                      height, sorted(set(fps), reverse=True)))
+        return name, formats
+    finally:
+        os.close(fd)
+
+
+def _probe_capture(index):
+    """Open a device with cv.VideoCapture and report its default format.
+    Return None if it cannot be opened.
+    """
+    camera = cv.VideoCapture(index)
+    try:
+        if not camera.isOpened():
+            return None
+        fourcc = _fourcc_str(int(camera.get(cv.CAP_PROP_FOURCC)))
+        fmt = Format(fourcc, int(camera.get(cv.CAP_PROP_FRAME_WIDTH)),
+                     int(camera.get(cv.CAP_PROP_FRAME_HEIGHT)),
+                     [camera.get(cv.CAP_PROP_FPS)])
+        return camera.getBackendName(), [fmt]
+    finally:
+        camera.release()
+
+
+def _device_nodes():
+    """Return a list of (index, path) of /dev/video* nodes or None if they
+    cannot be listed on this system.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    nodes = []
+    for path in glob.glob("/dev/video*"):
+        match = re.fullmatch(r"/dev/video(\d+)", path)
+        if match:
+            nodes.append((int(match.group(1)), path))
+    return sorted(nodes)
+
+
+def _run_parallel(fn, items, timeout):
+    """Call fn for every item in its own daemon thread and return a list of
+    results, None for calls which failed or did not finish within timeout.
+    """
+    results = [None] * len(items)
+
+    def run(idx, item):
+        try:
+            results[idx] = fn(item)
+        except Exception:
+            logging.debug("Probing {} failed.".format(item), exc_info=True)
+
+    threads = [threading.Thread(target=run, args=(idx, item), daemon=True)
+               for idx, item in enumerate(items)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout
+    for item, thread in zip(items, threads):
+        thread.join(max(0, deadline - time.monotonic()))
+        if thread.is_alive():
+            logging.warning("Probing {} timed out.".format(item))
+    return list(results)
+
+
+def _cache_key(nodes):
+    # Device nodes are recreated when cameras are plugged in
+    return [[path, os.stat(path).st_ctime] for _, path in nodes]
+
+
+def _load_cache(filename, key):
+    try:
+        with open(filename, "r") as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if data.get("key") != key:
+        return None
+    return [CameraInfo(index, path, name, [Format(*fmt) for fmt in formats])
+            for index, path, name, formats in data["cameras"]]
+
+
+def _save_cache(filename, key, cameras):
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as file:
+            json.dump({"key": key, "cameras": cameras}, file)
+    except OSError:
+        logging.warning("Unable to cache camera list in {}.".format(filename),
+                        exc_info=True)
+
+
+def probe_cameras(timeout=DEF_PROBE_TIMEOUT, cache=True):
+    """Return a list of CameraInfo of available capture devices. On Linux
+    /dev/video* nodes are queried for supported formats with V4L2 ioctls,
+    elsewhere the first DEF_PROBE_RANGE indices are opened with
+    cv.VideoCapture (only the default format is known then). Devices are
+    probed in parallel, ones which do not answer within timeout seconds are
+    skipped and every handle is released.
+
+    Results are cached in memory and, on Linux, in the cache file (or
+    DEF_PROBE_CACHE if cache is True) until the set of device nodes changes.
+    Set cache to False to always probe.
+    """
+    nodes = _device_nodes()
+    if nodes is None or fcntl is None:
+        key = None
+        if cache and key in _cache:
+            return _cache[key]
+        indices = list(range(DEF_PROBE_RANGE))
+        results = _run_parallel(_probe_capture, indices, timeout)
+        cameras = [CameraInfo(index, None, result[0], result[1])
+                   for index, result in zip(indices, results)
+                   if result is not None]
+    else:
+        key = _cache_key(nodes)
+        filename = DEF_PROBE_CACHE if cache is True else cache
+        if cache:
+            cameras = _cache.get(json.dumps(key))
+            if cameras is None:
+                cameras = _load_cache(filename, key)
+            if cameras is not None:
+                _cache[json.dumps(key)] = cameras
+                return cameras
+        results = _run_parallel(_probe_v4l2, [path for _, path in nodes],
+                                timeout)
+        cameras = [CameraInfo(index, path, result[0], result[1])
+                   for (index, path), result in zip(nodes, results)
+                   if result is not None]
+        if cache:
+            _save_cache(filename, key, cameras)
+        key = json.dumps(key)
+
+    if cache:
+        _cache[key] = cameras
+    return cameras
@@ -0,0 +1,202 @@
+from .cameras import Cameras
+from .exceptions import CameraCaptureError
+import cv2 as cv
+import os
+import queue
+import threading
+import time
+
+DEF_REPLAY_FPS = 30
+DEF_PREFETCH = 8
+
+
+class ImageSequenceCapture:
+    """Minimal cv.VideoCapture-like reader of images stored in a directory
+    (in the order of their file names).
+    """
+
+    def __init__(self, path, flags=cv.IMREAD_COLOR):
+        self.path = path
+        self.flags = flags
+        self.filenames = [os.path.join(path, f)
+                          for f in sorted(os.listdir(path))]
+        self.filenames = [f for f in self.filenames if cv.haveImageReader(f)]
+        self.index = 0
+
+    def isOpened(self):
+        return len(self.filenames) > 0
+
+    def read(self):
+        if self.index >= len(self.filenames):
+            return False, None
+        img = cv.imread(self.filenames[self.index], self.flags)
+        self.index += 1
+        return img is not None, img
+
+    def get(self, prop):
+        if prop == cv.CAP_PROP_FRAME_COUNT:
+            return len(self.filenames)
+        if prop == cv.CAP_PROP_POS_FRAMES:
+            return self.index
+        return 0
+
+    def set(self, prop, value):
+        if prop == cv.CAP_PROP_POS_FRAMES:
+            self.index = int(value)
+            return True
+        return False
+
+    def release(self):
+        self.filenames = []
+
+
+class ReplayCapture:
+    """cv.VideoCapture-like source which replays a directory of images or a
+    video file. Frames are decoded ahead by a background thread into a queue
+    of `prefetch` frames and handed out at `rate` times the recording frame
+    rate (as fast as possible if rate is None). CAP_PROP_POS_MSEC reports the
+    time of the frame within the recording. When the recording ends (and loop
+    is False), grab() returns False and `finished` is set. With gray, images
+    are read in grayscale.
+    """
+
+    def __init__(self, path, fps=None, rate=1.0, prefetch=DEF_PREFETCH,
+                 loop=False, gray=False):
+        self.path = path
+        if os.path.isdir(path):
+            self.source = ImageSequenceCapture(
+                path, cv.IMREAD_GRAYSCALE if gray else cv.IMREAD_COLOR)
+        else:
+            self.source = cv.VideoCapture(path)
+        if fps is None:
+            fps = self.source.get(cv.CAP_PROP_FPS) or DEF_REPLAY_FPS
+        self.fps = fps
+        self.rate = rate
+        self.loop = loop
+        self.finished = False
+
+        self.index = -1
+        self.image = None
+        self._start_time = None
+        self._queue = queue.Queue(maxsize=prefetch)
+        self._running = self.source.isOpened()
+        self._thread = threading.Thread(target=self._prefetch, daemon=True)
+        if self._running:
+            self._thread.start()
+
+    def _prefetch(self):
+        while self._running:
+            ret, image = self.source.read()
+            if not ret:
+                if self.loop and self.source.set(cv.CAP_PROP_POS_FRAMES, 0):
+                    continue
+                image = None
+            self._put(image)
+            if image is None:
+                break
+
+    def _put(self, image):
+        while self._running:
+            try:
+                self._queue.put(image, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def isOpened(self):
+        return self.source.isOpened()
+
+    def getBackendName(self):
+        return "REPLAY"
+
+    def grab(self):
+        if self.finished:
+            return False
+        image = self._queue.get()
+        if image is None:
+            self.finished = True
+            return False
+
+        self.index += 1
+        if self.rate:
+            if self._start_time is None:
+                self._start_time = time.monotonic()
+            delay = (self._start_time + self.index / (self.fps * self.rate)
+                     - time.monotonic())
+            if delay > 0:
+                time.sleep(delay)
+        self.image = image
+        return True
+
+    def retrieve(self):
+        return self.image is not None, self.image
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def get(self, prop):
+        if prop == cv.CAP_PROP_POS_MSEC:
+            return self.index * 1000 / self.fps
+        if prop == cv.CAP_PROP_POS_FRAMES:
+            return self.index + 1
+        if prop == cv.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv.CAP_PROP_FRAME_WIDTH and self.image is not None:
+            return self.image.shape[1]
+        if prop == cv.CAP_PROP_FRAME_HEIGHT and self.image is not None:
+            return self.image.shape[0]
+        return self.source.get(prop)
+
+    def set(self, prop, value):
+        """Replayed frames keep their recorded size and timing."""
+        return False
+
+    def release(self):
+        self._running = False
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        if self._thread.is_alive():
+            self._thread.join()
+        self.source.release()
+
+
+class ReplayCameras(Cameras):
+    """Cameras which replay recordings instead of capturing live frames, e.g.
+    to measure depth map throughput without hardware. Devices are paths of
+    image directories (like test-images/left and test-images/right) or video
+    files, one per camera, whose frames are paired by their order. Streams
+    end when any of the recordings ends, see ReplayCapture for the rest of
+    the parameters.
+    """
+
+    def __init__(self, devices, fps=None, rate=1.0, prefetch=DEF_PREFETCH,
+                 loop=False, **kwargs):
+        super().__init__(devices, fps=fps, **kwargs)
+        self.rate = rate
+        self.prefetch = prefetch
+        self.loop = loop
+
+    def _open_capture(self, device):
+        return ReplayCapture(device, self.fps, self.rate, self.prefetch,
+                             self.loop, self.gray)
+
+    def _read(self, cameras):
+        try:
+            return super()._read(cameras)
+        except CameraCaptureError:
+            if any(camera.finished for camera in cameras):
+                return None
+            raise
+
+    def _read_grabbers(self):
+        try:
+            return super()._read_grabbers()
+        except CameraCaptureError:
+            if any(grabber.camera.finished for grabber in self.grabbers):
+                return None
+            raise
@@ -1,8 +1,8 @@
+from .encoder import DEF_JPEG_QUALITY, DEF_MAX_DISPLAY_FPS, WidgetEncoder
+from .pipeline import DEF_QUEUE_SIZE, Pipeline
 from abc import ABC, abstractmethod
 import cv2 as cv
-import io
 import IPython
-import PIL.Image
 import ipywidgets
 import threading
 import logging
@@ -20,8 +20,12 @@ class Stream(ABC):
         self.last_time = time.time()
         self.fps = -1
         self.fps_avg = -1
+        self.pipeline = None
+        self.encoder = None
+        self.metrics = cameras.metrics
 
     def update_fps(self, log=True):
+        self.metrics.tick("render")
         deltatime = (time.time() - self.start_time)
         self.frames_count += 1
         if not (self.frames_count % 10):
@@ -42,7 +46,7 @@ class Stream(ABC):
 
     @abstractmethod
     def _cleanup(self, cameras):
-        pass
+        self._stop_pipeline()
 
     def _start(self):
         self._setup(self.cameras)
@@ -56,8 +60,46 @@ class Stream(ABC):
         except Exception:
             logging.error("Fatal exception in the main stream loop:",
                           exc_info=True)
+            self._stop_pipeline()
         self.running = False
 
+    def _start_pipeline(self, stages, queue_size):
+        self.pipeline = Pipeline(stages, queue_size).start()
+
+    def _stop_pipeline(self):
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline.join()
+
+    def _rectify_stage(self, item):
+        with self.metrics.measure("remap"):
+            item["left"], item["right"] = self.stereo.rectify(item["left"],
+                                                              item["right"])
+        return item
+
+    def _match_stage(self, item):
+        with self.metrics.measure("match"):
+            item["depth"] = self.stereo.match(item["left"], item["right"])
+        return item
+
+    def _calculate_depth(self, cameras):
+        """Calculate the visual depth map of the current frames, timing
+        rectification and matching separately.
+        """
+        self.stereo.left, self.stereo.right = cameras.frames[0], cameras.frames[1]
+        with self.metrics.measure("remap"):
+            self.stereo.preprocess_frames()
+        with self.metrics.measure("match"):
+            return self.stereo.calculate_depth(rectify=False)
+
+    def _start_encoder(self, quality, scale, max_fps):
+        self.encoder = WidgetEncoder(quality, scale, max_fps, self.metrics)
+        self.encoder.start()
+
+    def _stop_encoder(self):
+        if self.encoder is not None:
+            self.encoder.stop()
+
     @abstractmethod
     def start(self):
         pass
@@ -67,10 +109,18 @@ class Stream(ABC):
 
 
 class NStream(Stream):
-    def __init__(self, cameras, sep_thread=False):
+    def __init__(self, cameras, sep_thread=False,
+                 jpeg_quality=DEF_JPEG_QUALITY, display_scale=1.0,
+                 max_display_fps=DEF_MAX_DISPLAY_FPS):
+        """Frames are expected in RGB. They are encoded and displayed by
+        a background WidgetEncoder, see it for the display parameters.
+        """
         super().__init__(cameras)
         self.widgets = []
         self._sep_thread = sep_thread
+        self.jpeg_quality = jpeg_quality
+        self.display_scale = display_scale
+        self.max_display_fps = max_display_fps
 
     def _setup(self, cameras):
         logging.info("Starting jupyter notebook stream.")
@@ -78,17 +128,19 @@ class NStream(Stream):
             self.widgets.append(ipywidgets.Image(width=480))
         self.cameras.capture_black_screen()
         IPython.display.display(*self.widgets)
+        self._start_encoder(self.jpeg_quality, self.display_scale,
+                            self.max_display_fps)
         self._update(cameras)
 
     def _update(self, cameras):
+        self.metrics.tick("render")
         for frame, widget in zip(cameras.frames, self.widgets):
-            bytes_stream = io.BytesIO()
-            PIL.Image.fromarray(frame).save(bytes_stream, format="jpeg")
-            widget.value = bytes_stream.getvalue()
+            self.encoder.submit(widget, frame, rgb=True)
         return self.running
 
     def _cleanup(self, cameras):
         logging.info("Closing jupyter notebook stream.")
+        self._stop_encoder()
         for widget in self.widgets:
             widget.close()
 
@@ -106,34 +158,70 @@ class NStream(Stream):
 
 class DepthStream(Stream):
     def __init__(self, cameras, stereo, sep_thread=True, render_depth=True,
-                 render_preview=False):
+                 render_preview=False, pipelined=False,
+                 queue_size=DEF_QUEUE_SIZE):
         super().__init__(cameras)
         self._sep_thread = sep_thread
         self.stereo = stereo
         self.render_depth = render_depth
         self.render_preview = render_preview
+        self.pipelined = pipelined
+        self.queue_size = queue_size
 
     def _setup(self, cameras):
         logging.info("Starting depth map stream.")
+        if self.pipelined:
+            self._start_pipeline([
+                ("rectify", self._rectify_stage),
+                ("match", self._match_stage),
+                ("colorize", self._colorize_stage),
+                ("render", self._render_stage),
+            ], self.queue_size)
         self._update(cameras)
 
+    def _colorize_stage(self, item):
+        if self.render_depth:
+            with self.metrics.measure("colormap"):
+                item["depth"] = cv.applyColorMap(item["depth"],
+                                                 cv.COLORMAP_JET)
+        return item
+
+    def _render_stage(self, item):
+        self.update_fps()
+        with self.metrics.measure("display"):
+            if self.render_preview:
+                cv.imshow("Left", item["left"])
+
+            if self.render_depth:
+                cv.imshow("Depth", item["depth"])
+                if cv.waitKey(1) == ord("q"):
+                    self.pipeline.stop()
+        return item
+
     def _update(self, cameras):
+        if self.pipelined:
+            self.pipeline.put({"left": cameras.frames[0],
+                               "right": cameras.frames[1]})
+            return self.running and self.pipeline.running
+
         self.update_fps()
-        self.stereo.left, self.stereo.right = cameras.frames[0], cameras.frames[1]
-        depth = self.stereo.calculate_depth()
+        depth = self._calculate_depth(cameras)
 
         if self.render_preview:
-            cv.imshow("Left", self.stereo.left)
+            with self.metrics.measure("display"):
+                cv.imshow("Left", self.stereo.left_rectified)
 
         if self.render_depth:
-            depth = cv.applyColorMap(depth, cv.COLORMAP_JET)
-            cv.imshow("Depth", depth)
-            if cv.waitKey(1) == ord("q"):
-                return False
+            with self.metrics.measure("colormap"):
+                depth = cv.applyColorMap(depth, cv.COLORMAP_JET)
+            with self.metrics.measure("display"):
+                cv.imshow("Depth", depth)
+                if cv.waitKey(1) == ord("q"):
+                    return False
         return self.running
 
     def _cleanup(self, cameras):
-        pass
+        self._stop_pipeline()
 
     def start(self):
         if self._sep_thread:
@@ -148,9 +236,16 @@ class DepthStream(Stream):
 
 class NDepthStream(Stream):
     def __init__(self, cameras, stereo, sep_thread=True, render_depth=True,
-                 render_preview=False):
+                 render_preview=False, pipelined=False,
+                 queue_size=DEF_QUEUE_SIZE, jpeg_quality=DEF_JPEG_QUALITY,
+                 display_scale=1.0, max_display_fps=DEF_MAX_DISPLAY_FPS):
         super().__init__(cameras)
         self.stereo = stereo
+        self.pipelined = pipelined
+        self.queue_size = queue_size
+        self.jpeg_quality = jpeg_quality
+        self.display_scale = display_scale
+        self.max_display_fps = max_display_fps
 
         self.widgets = []
         self.widgets.append(ipywidgets.Image(width=720))
@@ -167,34 +262,61 @@ class NDepthStream(Stream):
         self.cameras.capture_black_screen()
         IPython.display.display(*self.widgets)
         IPython.display.display(self.widget_fps)
+        self._start_encoder(self.jpeg_quality, self.display_scale,
+                            self.max_display_fps)
+        if self.pipelined:
+            self._start_pipeline([
+                ("rectify", self._rectify_stage),
+                ("match", self._match_stage),
+                ("colorize", self._colorize_stage),
+                ("render", self._render_stage),
+            ], self.queue_size)
         self._update(cameras)
 
+    def _colorize_stage(self, item):
+        with self.metrics.measure("colormap"):
+            item["depth"] = cv.applyColorMap(item["depth"], cv.COLORMAP_JET)
+        return item
+
+    def _render_stage(self, item):
+        self.update_fps(False)
+        self.widget_fps.value = "FPS:\t{:.2f}\tAVG:\t{:.2f}" \
+            .format(self.fps, self.fps_avg)
+
+        if self.render_depth:
+            self.encoder.submit(self.widgets[0], item["depth"])
+
+        if self.render_preview:
+            self.encoder.submit(self.widgets[1], item["preview"])
+        return item
+
     def _update(self, cameras):
+        if self.pipelined:
+            self.pipeline.put({"left": cameras.frames[0],
+                               "right": cameras.frames[1],
+                               "preview": cameras.frames[0]})
+            return self.running and self.pipeline.running
+
         self.update_fps(False)
         self.widget_fps.value = "FPS:\t{:.2f}\tAVG:\t{:.2f}" \
             .format(self.fps, self.fps_avg)
 
-        self.stereo.left = cameras.frames[0]
-        self.stereo.right = cameras.frames[1]
-        depth = self.stereo.calculate_depth()
+        depth = self._calculate_depth(cameras)
 
-        depth = cv.applyColorMap(depth, cv.COLORMAP_JET)
-        depth = cv.cvtColor(depth, cv.COLOR_BGR2RGB)
+        with self.metrics.measure("colormap"):
+            depth = cv.applyColorMap(depth, cv.COLORMAP_JET)
 
         if self.render_depth:
-            bytes_stream = io.BytesIO()
-            PIL.Image.fromarray(depth).save(bytes_stream, format="jpeg")
-            self.widgets[0].value = bytes_stream.getvalue()
+            self.encoder.submit(self.widgets[0], depth)
 
         if self.render_preview:
-            bytes_stream = io.BytesIO()
-            PIL.Image.fromarray(self.cameras.frames[0]).save(bytes_stream,
-                                                             format="jpeg")
-            self.widgets[1].value = bytes_stream.getvalue()
+            self.encoder.submit(self.widgets[1], self.cameras.frames[0])
         return self.running
 
     def _cleanup(self, cameras):
         logging.info("Closing jupyter notebook stream.")
+        self._stop_pipeline()
+        self._stop_encoder()
         for widget in self.widgets:
             widget.close()
 
@@ -211,83 +333,32 @@ class NDepthStream(Stream):
 
 class NDepthStreamExt(NDepthStream):
     def __init__(self, cameras, stereo, sep_thread=True, render_depth=True,
-                 render_preview=False):
+                 render_preview=False, pipelined=False,
+                 queue_size=DEF_QUEUE_SIZE, jpeg_quality=DEF_JPEG_QUALITY,
+                 display_scale=1.0, max_display_fps=DEF_MAX_DISPLAY_FPS):
         super().__init__(cameras, stereo, sep_thread, render_depth,
-                         render_preview)
+                         render_preview, pipelined, queue_size, jpeg_quality,
+                         display_scale, max_display_fps)
         self.ext_params = {}
-        self.widgets_ext = {
-            "setBlockSize": (
-                ipywidgets.IntSlider(min=5, max=99, step=2),
-                lambda: self.stereo.stereo.getBlockSize(),
-                lambda v: self.stereo.stereo.setBlockSize(v["new"])
-            ),
-            "setMinDisparity": (
-                ipywidgets.IntSlider(min=-8, max=256, step=1),
-                lambda: self.stereo.stereo.getMinDisparity(),
-                lambda v: self.stereo.stereo.setMinDisparity(v["new"])
-            ),
-            "setNumDisparities": (
-                ipywidgets.IntSlider(min=16, max=256, step=16),
-                lambda: self.stereo.stereo.getNumDisparities(),
-                lambda v: self.stereo.stereo.setNumDisparities(v["new"])
-            ),
-            # "setDisp12MaxDiff":(
-            #     ipywidgets.IntSlider(min=-8, max=256, step=1),
-            #     lambda: self.stereo.stereo.getDisp12MaxDiff(),
-            #     lambda v: self.stereo.stereo.setDisp12MaxDiff(v["new"])
-            # ),
-            "setSpeckleRange": (
-                ipywidgets.IntSlider(min=-8, max=256, step=1),
-                lambda: self.stereo.stereo.getSpeckleRange(),
-                lambda v: self.stereo.stereo.setSpeckleRange(v["new"])
-            ),
-            "setSpeckleWindowSize": (
-                ipywidgets.IntSlider(min=-8, max=512, step=1),
-                lambda: self.stereo.stereo.getSpeckleWindowSize(),
-                lambda v: self.stereo.stereo.setSpeckleWindowSize(v["new"])
-            ),
-            "setTextureThreshold": (
-                ipywidgets.IntSlider(min=0, max=512, step=1),
-                lambda: self.stereo.stereo.getTextureThreshold(),
-                lambda v: self.stereo.stereo.setTextureThreshold(v["new"])
-            ),
-            "setPreFilterCap": (
-                ipywidgets.IntSlider(min=1, max=63, step=1),
-                lambda: self.stereo.stereo.getPreFilterCap(),
-                lambda v: self.stereo.stereo.setPreFilterCap(v["new"])
-            ),
-            "setPreFilterSize": (
-                ipywidgets.IntSlider(min=5, max=255, step=2),
-                lambda: self.stereo.stereo.getPreFilterSize(),
-                lambda v: self.stereo.stereo.setPreFilterSize(v["new"])
-            ),
-            "setPreFilterType": (
-                ipywidgets.Dropdown(
-                    options=(("PREFILTER_NORMALIZED_RESPONSE", 0), ("PREFILTER_XSOBEL", 1))),
-                lambda: self.stereo.stereo.getPreFilterType(),
-                lambda v: self.stereo.stereo.setPreFilterType(v["new"])
-            ),
-            "setSmallerBlockSize": (
-                ipywidgets.IntSlider(min=-1005, max=255, step=2),
-                lambda: self.stereo.stereo.getSmallerBlockSize(),
-                lambda v: self.stereo.stereo.setSmallerBlockSize(v["new"])
-            ),
-            # "setSpekleRemovalTechnique":(
-            #     ipywidgets.IntSlider(min=-1005, max=255, step=2),
-            #     lambda: self.stereo.stereo.getSpekleRemovalTechnique(),
-            #     lambda v: self.stereo.stereo.setSpekleRemovalTechnique(v["new"])
-            # ),
-            "setUniquenessRatio": (
-                ipywidgets.IntSlider(min=0, max=128, step=2),
-                lambda: self.stereo.stereo.getUniquenessRatio(),
-                lambda v: self.stereo.stereo.setUniquenessRatio(v["new"])
-            ),
-            # "setUsePrefilter":(
-            #     ipywidgets.Dropdown(options=(("TRUE", 1),("FALSE", 0))),
-            #     lambda: self.stereo.stereo.getUsePrefilter(),
-            #     lambda v: self.stereo.stereo.setUsePrefilter(v["new"])
-            # ),
-        }
+        # Widgets are generated from tunables of the active matcher backend
+        self.widgets_ext = {}
+        for name, spec in self.stereo.stereo.tunables.items():
+            self.widgets_ext["set" + name] = (
+                self._create_widget(spec),
+                lambda name=name: self.stereo.stereo.get(name),
+                lambda v, name=name: self.stereo.stereo.set(name, v["new"])
+            )
+
+    @staticmethod
+    def _create_widget(spec):
+        """Create a widget for the given matcher tunable specification."""
+        kind = spec[0]
+        if kind == "int":
+            return ipywidgets.IntSlider(min=spec[1], max=spec[2], step=spec[3])
+        elif kind == "float":
+            return ipywidgets.FloatSlider(min=spec[1], max=spec[2],
+                                          step=spec[3])
+        return ipywidgets.Dropdown(options=spec[1])
 
     def get_ext_params(self):
         params = {}
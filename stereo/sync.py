@@ -0,0 +1,92 @@
+DEF_MAX_REJECTED = 30
+
+
+def time_fn(stamps):
+    """Return a function giving the capture time (in seconds) of a Frame or
+    Timestamp. Backend timestamps are used only if every one of the given
+    stamps has them (see grabber.SHARED_CLOCK_BACKENDS), otherwise the
+    monotonic host time of the grab is used.
+    """
+    if all(stamp.pos_msec > 0 for stamp in stamps):
+        return lambda stamp: stamp.pos_msec / 1000
+    return lambda stamp: stamp.timestamp
+
+
+def skew(stamps):
+    """Return the spread (in seconds) of the capture times of the given
+    Frames or Timestamps.
+    """
+    fn = time_fn(stamps)
+    times = [fn(stamp) for stamp in stamps]
+    return max(times) - min(times)
+
+
+def match_frames(grabbers, timeout=None):
+    """Wait for a new frame from every grabber and take from each ring buffer
+    the frame closest in time to the oldest of the newest frames. Return a
+    (frames, skew) tuple or None if any grabber has stopped.
+    """
+    latest = []
+    for grabber in grabbers:
+        frame = grabber.wait(timeout)
+        if frame is None:
+            return None
+        latest.append(frame)
+
+    fn = time_fn(latest)
+    reference = min(fn(frame) for frame in latest)
+    frames = [grabber.nearest(fn, reference) for grabber in grabbers]
+    return frames, skew(frames)
+
+
+class SkewStats:
+    """Inter-camera skew statistics. Sets of frames with skew greater than
+    tolerance (in seconds) are counted as rejected, consecutive counts the
+    ones rejected since the last accepted set.
+    """
+
+    def __init__(self, tolerance=None):
+        self.tolerance = tolerance
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.rejected = 0
+        self.consecutive = 0
+        self.last = None
+        self.min = None
+        self.max = None
+        self.total = 0
+
+    def update(self, skew):
+        """Add a measured skew and return False if it exceeds the tolerance."""
+        self.count += 1
+        self.last = skew
+        self.total += skew
+        self.min = skew if self.min is None else min(self.min, skew)
+        self.max = skew if self.max is None else max(self.max, skew)
+        if self.tolerance is not None and skew > self.tolerance:
+            self.rejected += 1
+            self.consecutive += 1
+            return False
+        self.consecutive = 0
+        return True
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def get_dict(self):
+        """Return a dict with the statistics."""
+        return {
+            "count": self.count,
+            "rejected": self.rejected,
+            "consecutive": self.consecutive,
+            "last": self.last,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean,
+            "tolerance": self.tolerance,
+        }
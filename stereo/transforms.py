@@ -0,0 +1,207 @@
+import cv2 as cv
+import numpy as np
+
+
+def crop(img, x, y, width, height):
+    """Return a view of the given region of an image, to be used as
+    a transformation: (crop, x, y, width, height).
+    """
+    return img[y:y + height, x:x + width]
+
+
+def to_gray(img):
+    """Return the luma of a BGR or packed YUYV (2 channel) image, grayscale
+    images are returned as they are.
+    """
+    if img.ndim == 3 and img.shape[2] == 2:
+        return cv.cvtColor(img, cv.COLOR_YUV2GRAY_YUY2)
+    if img.ndim == 3 and img.shape[2] == 3:
+        return cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+    if img.ndim == 3 and img.shape[2] == 4:
+        return cv.cvtColor(img, cv.COLOR_BGRA2GRAY)
+    return img
+
+
+# Conversions to grayscale are linear and per pixel, so they commute with
+# cropping, flipping and linear filters (not moved before resizing, which is
+# cheaper first when it shrinks images)
+_TO_GRAY = {cv.COLOR_BGR2GRAY, cv.COLOR_RGB2GRAY, cv.COLOR_BGRA2GRAY,
+            cv.COLOR_RGBA2GRAY}
+# Other per pixel conversions which commute with cropping and flipping
+_PER_PIXEL = _TO_GRAY | {cv.COLOR_BGR2RGB, cv.COLOR_GRAY2BGR,
+                         cv.COLOR_GRAY2RGB, cv.COLOR_BGR2BGRA,
+                         cv.COLOR_BGRA2BGR, cv.COLOR_BGR2HSV,
+                         cv.COLOR_BGR2YCrCb, cv.COLOR_BGR2Lab}
+
+# Position of the dst argument (after the source image) of known functions
+_KINDS = {
+    cv.cvtColor: ("color", 1),
+    cv.resize: ("resize", 1),
+    cv.flip: ("flip", 1),
+    cv.GaussianBlur: ("filter", 2),
+    cv.blur: ("filter", 1),
+    cv.boxFilter: ("filter", 2),
+    crop: ("crop", None),
+}
+# Kinds which write into a new (or reused) buffer, not a view of the input
+_ALLOCATING = {"color", "resize", "flip", "filter"}
+
+
+class Step:
+    """Single transformation [function, arg1, arg2, ...] of a chain."""
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = tuple(args)
+        self.kind, self.dst_index = _KINDS.get(function, ("call", None))
+        self.reuse = False
+        self.dst = None
+
+    @property
+    def per_pixel(self):
+        return self.kind == "color" and len(self.args) == 1 \
+            and self.args[0] in _PER_PIXEL
+
+    @property
+    def to_gray(self):
+        return self.per_pixel and self.args[0] in _TO_GRAY
+
+    def _with_dst(self):
+        """Return the arguments with the reused buffer as dst or None if the
+        call already specifies its own dst.
+        """
+        if self.dst_index is None:
+            return None
+        if len(self.args) == self.dst_index:
+            return self.args + (self.dst,)
+        if self.args[self.dst_index] is None:
+            args = list(self.args)
+            args[self.dst_index] = self.dst
+            return tuple(args)
+        return None
+
+    def __call__(self, img):
+        args = self._with_dst() if self.reuse else None
+        if args is None:
+            return self.function(img, *self.args)
+        self.dst = self.function(img, *args)
+        return self.dst
+
+
+def _merge(first, second):
+    """Return a step equivalent to two consecutive steps, None if they cancel
+    out or False if they cannot be merged.
+    """
+    if first.kind == "crop" and second.kind == "crop" \
+            and len(first.args) == len(second.args) == 4:
+        x, y, width, height = first.args
+        x2, y2, width2, height2 = second.args
+        width2 = max(0, min(width2, width - x2))
+        height2 = max(0, min(height2, height - y2))
+        return Step(crop, (x + x2, y + y2, width2, height2))
+    if first.kind == "flip" and second.kind == "flip" \
+            and len(first.args) == len(second.args) == 1:
+        # Flip codes: 0 around x, positive around y, negative around both
+        def axes(code):
+            return {0} if code == 0 else ({1} if code > 0 else {0, 1})
+        flipped = axes(first.args[0]) ^ axes(second.args[0])
+        if not flipped:
+            return None
+        code = {frozenset({0}): 0, frozenset({1}): 1,
+                frozenset({0, 1}): -1}[frozenset(flipped)]
+        return Step(cv.flip, (code,))
+    # Swapping red and blue twice does nothing
+    if first.per_pixel and second.per_pixel \
+            and first.args[0] == second.args[0] == cv.COLOR_BGR2RGB:
+        return None
+    return False
+
+
+def _should_swap(first, second, exact=True):
+    """Return True if the second step can run first with the same result and
+    less work. Unless exact, results may differ by rounding.
+    """
+    if first.per_pixel and second.kind == "crop":
+        return True
+    if second.to_gray and first.kind == "flip":
+        return True
+    if not exact and second.to_gray and first.kind == "filter":
+        return True
+    return False
+
+
+class TransformChain:
+    """Compiled list of transformations [function, arg1, arg2, ...] applied
+    to frames of a single device. Common operations (cv.cvtColor, cv.resize,
+    cv.flip, cv.GaussianBlur, cv.blur and crop) are recognized: crops and
+    flips are merged, cropping is done before per pixel color conversions and
+    conversion to grayscale before flipping. Unless exact, conversion to
+    grayscale is also done before blurring, which is faster but may change
+    pixel values by rounding. Intermediate images are written into buffers
+    reused across frames, the final image is always a new array (or a view of
+    one), so it can be kept by the caller. Other functions are called as they
+    are and have to return a new image.
+    """
+
+    def __init__(self, transformations, reorder=True, exact=True):
+        self.steps = [Step(t[0], t[1:]) for t in transformations]
+        self.exact = exact
+        if reorder:
+            self._optimize()
+        self._plan_buffers()
+
+    def _optimize(self):
+        changed = True
+        while changed:
+            changed = False
+            for idx in range(len(self.steps) - 1):
+                first, second = self.steps[idx], self.steps[idx + 1]
+                merged = _merge(first, second)
+                if merged is not False:
+                    self.steps[idx:idx + 2] = [] if merged is None \
+                        else [merged]
+                    changed = True
+                    break
+                if _should_swap(first, second, self.exact):
+                    self.steps[idx], self.steps[idx + 1] = second, first
+                    changed = True
+                    break
+
+    def _plan_buffers(self):
+        # A buffer may be reused only if a later step copies the image out of
+        # it, otherwise the output would change under the caller
+        for idx, step in enumerate(self.steps):
+            step.reuse = step.kind in _ALLOCATING and any(
+                later.kind in _ALLOCATING for later in self.steps[idx + 1:])
+
+    def __call__(self, img):
+        for step in self.steps:
+            img = step(img)
+        return img
+
+    def placeholder(self, shape, dtype=np.uint8):
+        """Return a black image shaped like the output for an input of the
+        given shape without transforming a full size image if possible.
+        """
+        img = np.zeros(shape, dtype=dtype)
+        for step in self.steps:
+            if step.kind == "crop":
+                img = crop(img, *step.args)
+            elif step.kind == "resize" and step.args[0] is not None \
+                    and all(step.args[0]):
+                channels = img.shape[2:]
+                img = np.zeros(tuple(step.args[0])[::-1] + channels,
+                               dtype=img.dtype)
+            elif step.kind in ("flip", "filter"):
+                continue
+            elif step.kind == "color":
+                # Only the number of channels changes
+                try:
+                    small = step.function(img[:6, :6], *step.args)
+                    img = np.zeros(img.shape[:2] + small.shape[2:],
+                                   dtype=small.dtype)
+                except cv.error:
+                    img = step.function(img, *step.args)
+            else:
+                img = step.function(img, *step.args)
+        return np.zeros_like(img)
@@ -1,10 +1,7 @@
 import stereo as st
 import numpy as np
-import cv2 as cv
 
-cameras = st.Cameras([0,1], transformations=[
-    (cv.cvtColor, cv.COLOR_BGR2GRAY)
-])
+cameras = st.Cameras([0,1], gray=True)
 cameras.to_csi_device()
 
 calibration = st.Calibration2Cams()